@@ -1,99 +1,175 @@
 import time
-import requests
-import urllib3
+_T0 = time.perf_counter()  # Startup budget is measured from here
+
+# requests/urllib3 are imported only when the first trigger is sent, and
+# GPIO/sensor setup happens in main(), not at import time.
+import os
 import lgpio
+from concurrent.futures import ThreadPoolExecutor
 from VL53L0X import VL53L0X
+from distance_store import API_PORT, start_history, stop_history
+from event_journal import JOURNAL_DIR, open_journal
+from kiosk_config import load_config, startup_report
+from kiosk_http import new_session, notify_camera
+from kiosk_log import get_logger, span
 
 # ---------------- CONFIGURATION ----------------
 LED_PIN = 17
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-SERVER_URL = "https://172.27.44.17:4173/api/camera"
-DEVICE_NAME = "device1"  # Change per Raspberry Pi
+SERVER_IP = "172.27.44.17"
+PORT = "4173"
+DEVICE_NAME = "device1"  # Change per Raspberry Pi (or set KIOSK_DEVICE_NAME)
 
 THRESHOLD = 400
 AUTO_STOP_DELAY = 10
 SENSOR_POLL_DELAY = 0.1
+DISTANCE_API_PORT = API_PORT   # Query API for recorded distances
 
 MAX_RETRIES = 3        # Retry up to 3 times on request failure
 RETRY_DELAY = 1        # Delay between retries (seconds)
+CAMERA_EVENT_URL = ""  # Camera server /event (records a clip on presence), "" = off
 # ------------------------------------------------
 
-# ---------------- GPIO SETUP --------------------
-chip = lgpio.gpiochip_open(0)
-lgpio.gpio_claim_output(chip, LED_PIN)
-lgpio.gpio_write(chip, LED_PIN, 0)  # LED off
-# ------------------------------------------------
+log = get_logger("sensor")
 
-# ---------------- SENSOR SETUP ------------------
-sensor = VL53L0X()
-sensor.open()
-sensor.start_ranging()
-time.sleep(0.05)  # warm-up delay
+# ---------------- GLOBAL VARIABLES --------------
+SERVER_URL = ""
+http = None              # requests.Session, created on first trigger
+# Camera triggers run on one worker thread (keeps start/stop order) so
+# retries and network latency never stall the sensor loop.
+trigger_executor = None
+journal = None
 # ------------------------------------------------
 
-# ---------------- STATE VARIABLES ----------------
-last_seen = 0
-camera_on = False
-# ------------------------------------------------
+
+def get_http():
+    """Return the HTTP session, importing requests on first use"""
+    global http
+    if http is None:
+        http = new_session()
+    return http
+
 
 def trigger_camera(action):
     """Send camera trigger with retries"""
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            response = requests.post(
-                SERVER_URL,
-                json={"action": action, "device": DEVICE_NAME},
-                verify=False,
-                timeout=5
-            )
-            print(f"📸 {action} -> {response.status_code}")
+            with span("trigger_dispatch", action=action, attempt=attempt):
+                response = get_http().post(
+                    SERVER_URL,
+                    json={"action": action, "device": DEVICE_NAME},
+                    verify=False,
+                    timeout=5
+                )
+            log.info("📸 %s -> %s", action, response.status_code)
             return True
         except Exception as e:
-            print(f"❌ Attempt {attempt}: Failed to trigger camera ({e})")
+            log.warning("❌ Attempt %s: Failed to trigger camera (%s)", attempt, e)
             if attempt < MAX_RETRIES:
                 time.sleep(RETRY_DELAY)
             else:
-                print("⚠ All retries failed.")
+                log.error("⚠ All retries failed.")
                 return False
 
-print("Starting VL53L0X monitoring loop...")
 
-try:
-    while True:
-        try:
-            distance = sensor.get_distance()
-        except Exception as e:
-            print("⚠ Sensor read error:", e)
-            distance = 0
-
-        if distance == 0:
-            print("Distance: out of range / not ready")
-        else:
-            print(f"Distance: {distance} mm")
-
-        # Person detected
-        if 0 < distance <= THRESHOLD:
-            last_seen = time.time()
-            if not camera_on:
-                camera_on = True
-                trigger_camera("start_camera")
-                lgpio.gpio_write(chip, LED_PIN, 1)  # LED on
-
-        # Auto-stop after timeout
-        if camera_on and (time.time() - last_seen > AUTO_STOP_DELAY):
-            camera_on = False
-            trigger_camera("stop_camera")
-            lgpio.gpio_write(chip, LED_PIN, 0)  # LED off
-
-        time.sleep(SENSOR_POLL_DELAY)
-
-except KeyboardInterrupt:
-    print("\nExiting program...")
-finally:
-    # Cleanup
-    sensor.stop_ranging()
-    sensor.close()
-    lgpio.gpio_write(chip, LED_PIN, 0)
-    lgpio.gpiochip_close(chip)
-    print("Cleaned up GPIO and sensor")
+def main():
+    global SERVER_URL, DEVICE_NAME, THRESHOLD, AUTO_STOP_DELAY, DISTANCE_API_PORT, CAMERA_EVENT_URL
+    global trigger_executor, journal
+
+    config = load_config({
+        "server_ip": SERVER_IP,
+        "port": PORT,
+        "device_name": DEVICE_NAME,
+        "threshold": THRESHOLD,
+        "auto_stop_delay": AUTO_STOP_DELAY,
+        "distance_api_port": DISTANCE_API_PORT,
+        "camera_event_url": CAMERA_EVENT_URL,
+    }, description="VL53L0X presence sensor loop")
+    SERVER_URL = f"https://{config['server_ip']}:{config['port']}/api/camera"
+    DEVICE_NAME = config["device_name"]
+    THRESHOLD = config["threshold"]
+    AUTO_STOP_DELAY = config["auto_stop_delay"]
+    DISTANCE_API_PORT = config["distance_api_port"]
+    CAMERA_EVENT_URL = config["camera_event_url"]
+
+    trigger_executor = ThreadPoolExecutor(max_workers=1)
+    trigger_executor.submit(get_http)  # Import requests off the sensing path
+    journal = open_journal(os.path.join(JOURNAL_DIR, "sensor"),
+                           SERVER_URL.replace("/api/camera", "/api/events"), DEVICE_NAME)
+
+    # ---------------- GPIO SETUP --------------------
+    chip = lgpio.gpiochip_open(0)
+    lgpio.gpio_claim_output(chip, LED_PIN)
+    lgpio.gpio_write(chip, LED_PIN, 0)  # LED off
+    # ------------------------------------------------
+
+    # ---------------- SENSOR SETUP ------------------
+    sensor = VL53L0X()
+    sensor.open()
+    sensor.start_ranging()
+    time.sleep(0.05)  # warm-up delay
+    # ------------------------------------------------
+
+    # ---------------- DISTANCE HISTORY -------------
+    store, distance_api = start_history(THRESHOLD, DISTANCE_API_PORT)
+    # ------------------------------------------------
+
+    # ---------------- STATE VARIABLES ----------------
+    last_seen = 0
+    camera_on = False
+    # ------------------------------------------------
+
+    print("Starting VL53L0X monitoring loop...")
+    startup_report("Sensor loop", _T0)
+
+    try:
+        while True:
+            try:
+                with span("sensor_read"):
+                    distance = sensor.get_distance()
+            except Exception as e:
+                log.warning("⚠ Sensor read error: %s", e, every=5)
+                distance = 0
+            now = time.time()
+            store.add(now, distance)
+
+            if distance == 0:
+                log.debug("Distance: out of range / not ready")
+            else:
+                log.debug("Distance: %s mm", distance)
+
+            # Person detected
+            if 0 < distance <= THRESHOLD:
+                last_seen = now
+                if not camera_on:
+                    camera_on = True
+                    journal.append("presence", {"action": "start_camera", "distance": distance})
+                    trigger_executor.submit(trigger_camera, "start_camera")
+                    notify_camera(CAMERA_EVENT_URL, get_http, "presence", DEVICE_NAME, {"distance": distance})
+                    lgpio.gpio_write(chip, LED_PIN, 1)  # LED on
+
+            # Auto-stop after timeout
+            if camera_on and (now - last_seen > AUTO_STOP_DELAY):
+                camera_on = False
+                journal.append("presence", {"action": "stop_camera"})
+                trigger_executor.submit(trigger_camera, "stop_camera")
+                lgpio.gpio_write(chip, LED_PIN, 0)  # LED off
+
+            time.sleep(SENSOR_POLL_DELAY)
+
+    except KeyboardInterrupt:
+        print("\nExiting program...")
+    finally:
+        # Cleanup
+        trigger_executor.shutdown(wait=True)
+        journal.close()
+        stop_history(store, distance_api)
+        sensor.stop_ranging()
+        sensor.close()
+        lgpio.gpio_write(chip, LED_PIN, 0)
+        lgpio.gpiochip_close(chip)
+        print("Cleaned up GPIO and sensor")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,53 @@
 import time
-import requests
-import urllib3
+_T0 = time.perf_counter()  # Startup budget is measured from here
+
+# requests/urllib3 and tkinter are imported only when first needed, so a
+# headless kiosk reaches the sensing loop without loading them.
+import os
 import lgpio
+from concurrent.futures import ThreadPoolExecutor
 from VL53L0X import VL53L0X
+from distance_store import API_PORT, start_history, stop_history
+from event_journal import JOURNAL_DIR, open_journal
+from kiosk_config import load_config, startup_report
+from kiosk_http import new_session, notify_camera
+from kiosk_log import get_logger, span
 import subprocess
-import tkinter as tk
-from tkinter import messagebox
+import threading
 
 # ---------------- CONFIGURATION ----------------
-LED_PIN = 17
+LED_PIN = 17            # Status LED (GPIO 24 when the supervisor also runs the turnstile)
 PORT = "4173"
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 THRESHOLD = 600
 AUTO_STOP_DELAY = 10
 SENSOR_POLL_DELAY = 0.1
+DISTANCE_API_PORT = API_PORT   # Query API for recorded distances
 
 MAX_RETRIES = 3
 RETRY_DELAY = 1
+CAMERA_EVENT_URL = ""   # Camera server /event (records a clip on presence), "" = off
 # ------------------------------------------------
 
+log = get_logger("sensor")
+
 # ---------------- GLOBAL VARIABLES --------------
 WEB_URL = ""
 SERVER_URL = ""
 DEVICE_NAME = ""
+journal = None
+http = None                      # requests.Session, created lazily (or injected by the supervisor)
+stop_event = threading.Event()   # Set to end the sensor loop
+# Camera triggers run on one worker thread (keeps start/stop order) so
+# retries and network latency never stall the sensor loop.
+trigger_executor = None
 # ------------------------------------------------
 
-def start_program():
-    """Triggered after user presses Enter on GUI"""
+def configure(ip_input, device_name):
+    """Build server URLs"""
     global WEB_URL, SERVER_URL, DEVICE_NAME
 
-    ip_input = ip_entry.get().strip()
-    DEVICE_NAME = device_entry.get().strip()
-
-    if not ip_input or not DEVICE_NAME:
-        messagebox.showerror("Error", "Please enter both IP and Device Name.")
-        return
+    DEVICE_NAME = device_name
 
     # Build URLs automatically
     WEB_URL = f"https://{ip_input}:{PORT}/"
@@ -45,10 +57,39 @@ def start_program():
     print(f"SERVER_URL: {SERVER_URL}")
     print(f"DEVICE_NAME: {DEVICE_NAME}")
 
+
+def get_http():
+    """Return the HTTP session, importing requests on first use"""
+    global http
+    if http is None:
+        http = new_session()
+    return http
+
+
+def start_program():
+    """Triggered after user presses Enter on GUI"""
+    from tkinter import messagebox
+
+    ip_input = ip_entry.get().strip()
+    device_name = device_entry.get().strip()
+
+    if not ip_input or not device_name:
+        messagebox.showerror("Error", "Please enter both IP and Device Name.")
+        return
+
+    configure(ip_input, device_name)
+
     # Close GUI window
     root.destroy()
 
-    # Open Chromium in kiosk mode
+    launch_chromium()
+
+    # Start the VL53L0X sensor loop
+    start_sensor_loop()
+
+
+def launch_chromium():
+    """Open Chromium in kiosk mode"""
     print("Launching Chromium kiosk...")
     subprocess.Popen([
         "/usr/bin/chromium",
@@ -61,73 +102,108 @@ def start_program():
         WEB_URL
     ])
 
-    # Start the VL53L0X sensor loop
-    start_sensor_loop()
-
 
 def trigger_camera(action):
     """Send camera trigger with retries"""
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            response = requests.post(
-                SERVER_URL,
-                json={"action": action, "device": DEVICE_NAME},
-                verify=False,
-                timeout=5
-            )
-            print(f"📸 {action} -> {response.status_code}")
+            with span("trigger_dispatch", action=action, attempt=attempt):
+                response = get_http().post(
+                    SERVER_URL,
+                    json={"action": action, "device": DEVICE_NAME},
+                    verify=False,
+                    timeout=5
+                )
+            log.info("📸 %s -> %s", action, response.status_code)
             return True
         except Exception as e:
-            print(f"❌ Attempt {attempt}: Failed to trigger camera ({e})")
+            log.warning("❌ Attempt %s: Failed to trigger camera (%s)", attempt, e)
             if attempt < MAX_RETRIES:
                 time.sleep(RETRY_DELAY)
             else:
-                print("⚠ All retries failed.")
+                log.error("⚠ All retries failed.")
                 return False
 
 
-def start_sensor_loop():
-    """Main sensor loop AFTER GUI"""
-    print("Initializing GPIO and VL53L0X...")
+def stop():
+    """Ask the sensor loop to exit"""
+    stop_event.set()
 
-    chip = lgpio.gpiochip_open(0)
-    lgpio.gpio_claim_output(chip, LED_PIN)
-    lgpio.gpio_write(chip, LED_PIN, 0)
 
-    sensor = VL53L0X()
-    sensor.open()
-    sensor.start_ranging()
-    time.sleep(0.05)
+def start_sensor_loop(handle=None, on_ready=None):
+    """Main sensor loop AFTER GUI.
 
-    last_seen = 0
-    camera_on = False
+    With `handle`, LED_PIN was already claimed on that chip by the kiosk
+    supervisor, which also owns (and closes) the chip. `on_ready` is called
+    right before the first reading. Everything opened here is released on
+    exit, including when setup fails (e.g. a flaky I2C bus), so supervisor
+    restarts do not leak threads or handles.
+    """
+    global trigger_executor, journal
 
-    print("Starting VL53L0X monitoring loop...")
+    print("Initializing GPIO and VL53L0X...")
+
+    stop_event.clear()
+    chip = handle
+    sensor = None
+    ranging = False
+    store = None
+    distance_api = None
 
     try:
-        while True:
+        if handle is None:
+            chip = lgpio.gpiochip_open(0)
+            lgpio.gpio_claim_output(chip, LED_PIN)
+        lgpio.gpio_write(chip, LED_PIN, 0)
+
+        journal = open_journal(os.path.join(JOURNAL_DIR, "sensor"), WEB_URL + "api/events", DEVICE_NAME)
+        trigger_executor = ThreadPoolExecutor(max_workers=1)
+        trigger_executor.submit(get_http)  # Import requests off the sensing path
+
+        sensor = VL53L0X()
+        sensor.open()
+        sensor.start_ranging()
+        ranging = True
+        time.sleep(0.05)
+
+        store, distance_api = start_history(THRESHOLD, DISTANCE_API_PORT)
+
+        last_seen = 0
+        camera_on = False
+
+        print("Starting VL53L0X monitoring loop...")
+        if on_ready:
+            on_ready()
+
+        while not stop_event.is_set():
             try:
-                distance = sensor.get_distance()
+                with span("sensor_read"):
+                    distance = sensor.get_distance()
             except Exception as e:
-                print("⚠ Sensor read error:", e)
+                log.warning("⚠ Sensor read error: %s", e, every=5)
                 distance = 0
+            now = time.time()
+            store.add(now, distance)
 
             if distance == 0:
-                print("Distance: out of range / not ready")
+                log.debug("Distance: out of range / not ready")
             else:
-                print(f"Distance: {distance} mm")
+                log.debug("Distance: %s mm", distance)
 
             if 0 < distance <= THRESHOLD:
-                last_seen = time.time()
+                last_seen = now
 
                 if not camera_on:
                     camera_on = True
-                    trigger_camera("start_camera")
+                    journal.append("presence", {"action": "start_camera", "distance": distance})
+                    trigger_executor.submit(trigger_camera, "start_camera")
+                    notify_camera(CAMERA_EVENT_URL, get_http, "presence", DEVICE_NAME, {"distance": distance})
                     lgpio.gpio_write(chip, LED_PIN, 1)
 
-            if camera_on and (time.time() - last_seen > AUTO_STOP_DELAY):
+            if camera_on and (now - last_seen > AUTO_STOP_DELAY):
                 camera_on = False
-                trigger_camera("stop_camera")
+                journal.append("presence", {"action": "stop_camera"})
+                trigger_executor.submit(trigger_camera, "stop_camera")
                 lgpio.gpio_write(chip, LED_PIN, 0)
 
             time.sleep(SENSOR_POLL_DELAY)
@@ -136,27 +212,97 @@ def start_sensor_loop():
         print("\nExiting program...")
 
     finally:
-        sensor.stop_ranging()
-        sensor.close()
-        lgpio.gpio_write(chip, LED_PIN, 0)
-        lgpio.gpiochip_close(chip)
+        if trigger_executor:
+            trigger_executor.shutdown(wait=True)
+            trigger_executor = None
+        if journal:
+            journal.close()
+            journal = None
+        stop_history(store, distance_api)
+        if sensor:
+            try:
+                if ranging:
+                    sensor.stop_ranging()
+                sensor.close()
+            except Exception as e:
+                log.warning("⚠ Sensor cleanup failed: %s", e)
+        if chip is not None:
+            try:
+                lgpio.gpio_write(chip, LED_PIN, 0)
+            except Exception as e:
+                log.warning("⚠ LED cleanup failed: %s", e)
+            if handle is None:
+                lgpio.gpiochip_close(chip)
         print("Cleaned up GPIO and sensor")
 
 
 # ---------------- GUI SETUP ----------------
-root = tk.Tk()
-root.title("Sensor Configuration")
-root.geometry("400x180")
-
-tk.Label(root, text="Enter Server IP (example: 172.27.44.17)").pack(pady=5)
-ip_entry = tk.Entry(root, width=30)
-ip_entry.pack()
+def run_gui(config):
+    """Ask for server IP and device name, prefilled from the config"""
+    global root, ip_entry, device_entry
+    import tkinter as tk
+
+    root = tk.Tk()
+    root.title("Sensor Configuration")
+    root.geometry("400x180")
+
+    tk.Label(root, text="Enter Server IP (example: 172.27.44.17)").pack(pady=5)
+    ip_entry = tk.Entry(root, width=30)
+    ip_entry.insert(0, config["server_ip"])
+    ip_entry.pack()
+
+    tk.Label(root, text="Enter Device Name (example: device1)").pack(pady=5)
+    device_entry = tk.Entry(root, width=30)
+    device_entry.insert(0, config["device_name"])
+    device_entry.pack()
+
+    start_button = tk.Button(root, text="ENTER", command=start_program, width=20)
+    start_button.pack(pady=20)
+
+    root.mainloop()
+
+
+def load_sensor_config(argv=None):
+    """Load kiosk.json / KIOSK_* / command line and apply the sensor settings.
+
+    Used by main() and by the kiosk supervisor (argv=[]), so both honour the
+    same keys. Returns the whole config; server_ip and device_name are left
+    to the caller (see configure()).
+    """
+    global PORT, THRESHOLD, AUTO_STOP_DELAY, DISTANCE_API_PORT, CAMERA_EVENT_URL
+
+    config = load_config({
+        "server_ip": "",
+        "device_name": "",
+        "port": PORT,
+        "threshold": THRESHOLD,
+        "auto_stop_delay": AUTO_STOP_DELAY,
+        "distance_api_port": DISTANCE_API_PORT,
+        "camera_event_url": CAMERA_EVENT_URL,
+        "chromium": True,   # --no-chromium for a sensor-only node
+        "gui": False,       # --gui forces the configuration window
+    }, argv=argv, description="VL53L0X presence sensor app")
+    PORT = config["port"]
+    THRESHOLD = config["threshold"]
+    AUTO_STOP_DELAY = config["auto_stop_delay"]
+    DISTANCE_API_PORT = config["distance_api_port"]
+    CAMERA_EVENT_URL = config["camera_event_url"]
+    return config
+
+
+def main():
+    """Start headless when server IP and device name are configured, else show the GUI"""
+    config = load_sensor_config()
+
+    if config["gui"] or not (config["server_ip"] and config["device_name"]):
+        run_gui(config)
+        return
 
-tk.Label(root, text="Enter Device Name (example: device1)").pack(pady=5)
-device_entry = tk.Entry(root, width=30)
-device_entry.pack()
+    configure(config["server_ip"], config["device_name"])
+    if config["chromium"]:
+        launch_chromium()
+    start_sensor_loop(on_ready=lambda: startup_report("Sensor app", _T0))
 
-start_button = tk.Button(root, text="ENTER", command=start_program, width=20)
-start_button.pack(pady=20)
 
-root.mainloop()
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,84 @@
 #!/usr/bin/env python3
 import cv2
 import asyncio
-from aiohttp import web
+import fractions
+import os
+import threading
+import time
+import numpy as np
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
 from aiortc import (
     RTCPeerConnection,
     RTCSessionDescription,
     VideoStreamTrack,
 )
-from aiortc.contrib.media import MediaBlackhole, MediaRecorder
 from aiortc.rtcrtpsender import RTCRtpSender
 from av import VideoFrame
 
-# --- Webcam Video Track ---
-class CameraVideoTrack(VideoStreamTrack):
+from clip_recorder import ClipRecorder, CLIP_DIR, JPEG_QUALITY
+from qr_decoder import QrDecoder
+
+# --- Motion / ROI Configuration ---
+ACTIVE_FPS = 30               # Stream rate while something moves
+STATIC_FPS = 5                # Stream rate for an empty, unchanging lane
+MOTION_SIZE = (80, 45)        # Detector works on this downscaled grayscale frame
+MOTION_PIXEL_DELTA = 18       # Per-pixel change (0-255) that counts as motion
+MOTION_FRACTION = 0.01        # Fraction of changed ROI pixels that means "active"
+MOTION_HOLD = 2.0             # Seconds to stay active after the last motion
+# Region of interest (lane / QR area) as x, y, w, h fractions of the frame,
+# e.g. CAMERA_ROI="0.3,0.2,0.4,0.6". Motion is detected inside it, and
+# offers with {"roi": true} get it as a second, full-resolution track.
+ROI = tuple(float(v) for v in os.environ.get("CAMERA_ROI", "0.25,0.1,0.5,0.8").split(","))
+BACKGROUND_SCALE = 0.5        # Full view is downscaled when the ROI track is sent
+# QR payloads decoded from the camera are posted here (unset = log only)
+VERIFY_URL = os.environ.get("CAMERA_VERIFY_URL", "")
+DEVICE_NAME = os.environ.get("CAMERA_DEVICE_NAME", "device1")
+MJPEG_FPS = 10                # Max rate per /stream.mjpg client (lower with ?fps=)
+MJPEG_MIN_FPS = 0.2           # Lowest ?fps= honoured
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+
+def roi_slices(shape, roi=ROI):
+    """Return (rows, cols) slices of `roi` for an image of `shape`"""
+    height, width = shape[:2]
+    x, y, w, h = roi
+    # Even offsets and sizes keep the crop encodable as YUV 4:2:0
+    top, left = int(y * height) & ~1, int(x * width) & ~1
+    return (slice(top, top + (int(h * height) & ~1)),
+            slice(left, left + (int(w * width) & ~1)))
+
+
+# --- Motion Detector ---
+class MotionDetector:
+    """Cheap change detector: frame differencing on a tiny grayscale copy
+    of the ROI, run on the capture thread."""
+
+    def __init__(self):
+        self.previous = None
+        self.active = True         # Start active so the first viewer sees a live stream
+        self.last_motion = time.time()
+        self.changed = 0.0         # Fraction of ROI pixels changed in the last frame
+
+    def __call__(self, timestamp, frame):
+        small = cv2.resize(frame, MOTION_SIZE, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)[roi_slices(MOTION_SIZE[::-1])]
+        if self.previous is not None:
+            diff = cv2.absdiff(gray, self.previous)
+            self.changed = np.count_nonzero(diff > MOTION_PIXEL_DELTA) / diff.size
+            if self.changed >= MOTION_FRACTION:
+                self.last_motion = timestamp
+        self.previous = gray
+        self.active = timestamp - self.last_motion < MOTION_HOLD
+
+# --- Shared Capture Loop ---
+class FrameSource:
+    """Reads the camera once on a background thread for every consumer
+    (WebRTC tracks, the clip recorder, snapshot/MJPEG clients); consumers
+    take the latest frame. JPEG encoding is memoized per captured frame,
+    so JPEG readers of the same frame share one encode."""
+
     def __init__(self):
-        super().__init__()
         self.cap = None
         for device in [0, 1, 2, 3]:
             cap = cv2.VideoCapture(device)
@@ -29,22 +93,202 @@ class CameraVideoTrack(VideoStreamTrack):
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
         self.cap.set(cv2.CAP_PROP_FPS, 30)
 
+        self.frame = None          # Latest BGR frame
+        self.generation = 0        # Increments with every captured frame
+        self.listeners = []        # fn(timestamp, frame), called on the capture thread
+        self._running = False
+        self._thread = None
+        self._jpeg_cache = (None, None)   # (frame, JPEG bytes) of the last encode
+        self._jpeg_params = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]
+        self._loop = None
+        self._new_frame = None     # asyncio.Event, replaced after each frame
+
+    def jpeg(self, frame=None):
+        """JPEG bytes of `frame` (default: the latest), reusing the cached encode.
+
+        Lock-free: the cache is one (frame, bytes) tuple swapped atomically, so
+        the capture thread (clip recorder) never waits behind a client's encode.
+        """
+        if frame is None:
+            frame = self.frame
+        cached_frame, cached = self._jpeg_cache
+        if frame is None or frame is cached_frame:
+            return cached
+        ok, buf = cv2.imencode(".jpg", frame, self._jpeg_params)
+        if not ok:
+            return cached
+        jpeg = buf.tobytes()
+        self._jpeg_cache = (frame, jpeg)
+        return jpeg
+
+    async def wait_frame(self, after):
+        """Wait until a frame newer than generation `after` exists; return its generation"""
+        while self.generation <= after:
+            if self._new_frame is None:
+                self._loop = asyncio.get_running_loop()
+                self._new_frame = asyncio.Event()
+            await self._new_frame.wait()
+        return self.generation
+
+    def _notify(self):
+        event, self._new_frame = self._new_frame, None
+        if event is not None:
+            event.set()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._capture_loop, name="camera-capture", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=2)
+        self.cap.release()
+
+    def _capture_loop(self):
+        while self._running:
+            ret, frame = self.cap.read()
+            if not ret:
+                time.sleep(0.05)
+                continue
+            now = time.time()
+            self.frame = frame
+            self.generation += 1
+            if self._new_frame is not None:
+                # Only wake the event loop when someone is waiting
+                self._loop.call_soon_threadsafe(self._notify)
+            for listener in self.listeners:
+                try:
+                    listener(now, frame)
+                except Exception as e:
+                    print("[ERROR] Frame listener failed:", e)
+
+
+# --- Webcam Video Track ---
+class CameraVideoTrack(VideoStreamTrack):
+    """Streams the shared capture at ACTIVE_FPS while the motion detector
+    sees activity and at STATIC_FPS otherwise, so encoder CPU and uplink
+    follow scene activity."""
+
+    def __init__(self, source, motion, scale=1.0):
+        super().__init__()
+        self.source = source
+        self.motion = motion
+        self.scale = scale
+        self._start = None
+        self._next = 0.0
+
+    def prepare(self, frame):
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return frame
+
+    async def _pace(self):
+        # Monotonic clock: an NTP step of the wall clock (no RTC battery)
+        # must not freeze the stream or jump the RTP timestamps
+        now = time.monotonic()
+        if self._start is None:
+            self._start = self._next = now
+        # Sleep in short slices so motion switches back to full rate promptly
+        while now < self._next:
+            if self.motion.active and self._next - now > 1 / ACTIVE_FPS:
+                self._next = now + 1 / ACTIVE_FPS
+            await asyncio.sleep(min(self._next - now, 1 / ACTIVE_FPS))
+            now = time.monotonic()
+        fps = ACTIVE_FPS if self.motion.active else STATIC_FPS
+        self._next = max(self._next + 1 / fps, now)
+        return int((now - self._start) * VIDEO_CLOCK_RATE)
+
     async def recv(self):
-        pts, time_base = await self.next_timestamp()
-        ret, frame = self.cap.read()
-        if not ret:
+        pts = await self._pace()
+        frame = self.source.frame
+        while frame is None:
             await asyncio.sleep(0.05)
-            return await self.recv()
+            frame = self.source.frame
 
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        vframe = VideoFrame.from_ndarray(frame, format="rgb24")
+        # Encode straight from BGR; no per-frame color conversion
+        vframe = VideoFrame.from_ndarray(self.prepare(frame), format="bgr24")
         vframe.pts = pts
-        vframe.time_base = time_base
+        vframe.time_base = VIDEO_TIME_BASE
         return vframe
 
 
+class RoiVideoTrack(CameraVideoTrack):
+    """Full-resolution crop of the region of interest"""
+
+    def prepare(self, frame):
+        return np.ascontiguousarray(frame[roi_slices(frame.shape)])
+
+
+# --- MJPEG Broadcast ---
+class MjpegBroadcaster:
+    """One producer task encodes a JPEG per MJPEG tick (MJPEG_FPS) while any
+    /stream.mjpg client is connected; every client sends that same cached
+    frame, so ten clients cost the same encodes as one."""
+
+    def __init__(self, source, fps=MJPEG_FPS):
+        self.source = source
+        self.interval = 1 / fps
+        self.clients = 0
+        self.tick = 0              # Increments with every produced JPEG
+        self.jpeg = None
+        self._task = None
+        self._changed = asyncio.Event()
+
+    def join(self):
+        """Register a client; returns the tick to pass to the first next()"""
+        self.clients += 1
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._produce())
+            return self.tick       # Cached JPEG is stale: wait for a fresh one
+        if self.jpeg is None:
+            return self.tick       # Producer has not made its first JPEG yet
+        return self.tick - 1       # Producer is live: start from its latest JPEG
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def leave(self):
+        self.clients -= 1
+
+    async def next(self, after):
+        """Wait for a JPEG newer than tick `after`; return (tick, jpeg)"""
+        while self.tick <= after:
+            await self._changed.wait()
+        return self.tick, self.jpeg
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        generation = 0
+        try:
+            while self.clients:
+                started = loop.time()
+                generation = await self.source.wait_frame(generation)
+                try:
+                    jpeg = await loop.run_in_executor(None, self.source.jpeg)
+                except Exception as e:
+                    print("[ERROR] MJPEG encode failed:", e)
+                    jpeg = None
+                if jpeg:
+                    self.jpeg = jpeg
+                    self.tick += 1
+                    changed, self._changed = self._changed, asyncio.Event()
+                    changed.set()
+                await asyncio.sleep(max(0.0, self.interval - (loop.time() - started)))
+        finally:
+            self._task = None
+
+
 # --- Web Server ---
 pcs = set()
+source = None
+recorder = None
+motion = None
+qr = None
+http = None
+mjpeg = None
 
 async def index(request):
     return web.FileResponse("index.html")
@@ -58,8 +302,12 @@ async def offer(request):
         pc = RTCPeerConnection()
         pcs.add(pc)
 
-        video = CameraVideoTrack()
-        pc.addTrack(video)
+        if params.get("roi"):
+            # Background at reduced resolution plus the ROI at full resolution
+            pc.addTrack(CameraVideoTrack(source, motion, scale=BACKGROUND_SCALE))
+            pc.addTrack(RoiVideoTrack(source, motion))
+        else:
+            pc.addTrack(CameraVideoTrack(source, motion))
 
         await pc.setRemoteDescription(offer)
         answer = await pc.createAnswer()
@@ -81,6 +329,106 @@ async def offer(request):
         return web.json_response({"error": str(e)}, status=500)
 
 
+async def snapshot(request):
+    """Latest frame as a JPEG, shared with every other JPEG consumer"""
+    await source.wait_frame(0)
+    jpeg = await asyncio.get_running_loop().run_in_executor(None, source.jpeg)
+    return web.Response(body=jpeg, content_type="image/jpeg",
+                        headers={"Cache-Control": "no-cache"})
+
+
+async def stream_mjpg(request):
+    """MJPEG stream of the shared broadcast frames; a slow client skips to the
+    newest frame instead of queueing"""
+    try:
+        fps = float(request.query.get("fps", MJPEG_FPS))
+    except ValueError:
+        fps = MJPEG_FPS
+    # Clamp to [MJPEG_MIN_FPS, MJPEG_FPS]; zero, negative and NaN get the default
+    fps = min(max(fps, MJPEG_MIN_FPS), MJPEG_FPS) if fps > 0 else MJPEG_FPS
+    response = web.StreamResponse(headers={
+        "Content-Type": "multipart/x-mixed-replace; boundary=frame",
+        "Cache-Control": "no-cache",
+    })
+    await response.prepare(request)
+    loop = asyncio.get_running_loop()
+    tick = mjpeg.join()
+    try:
+        while True:
+            started = loop.time()
+            tick, jpeg = await mjpeg.next(tick)
+            # write() waits for the socket to drain: that is the per-client backpressure
+            await response.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                                 + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
+            await asyncio.sleep(max(0.0, 1 / fps - (loop.time() - started)))
+    except ConnectionResetError:
+        pass  # Client went away
+    finally:
+        mjpeg.leave()
+    return response
+
+
+async def event(request):
+    """Record a clip around an event, e.g. {"event": "failed", "studentId": "123"}.
+
+    The sensor loop (presence) and the turnstile controller (unlock, failed)
+    post here when their camera_event_url is set; "time" is the unix time the
+    event happened.
+    """
+    try:
+        params = await request.json()
+        name = params.pop("event")
+        event_time = params.pop("time", None)
+        event_time = float(event_time) if event_time is not None else None
+    except Exception:
+        return web.json_response({"error": "expected JSON with an 'event' field"}, status=400)
+    recorder.trigger(name, params, event_time)
+    return web.json_response({"recording": name})
+
+
+async def post_qr(payload):
+    """Send a camera-decoded QR payload down the verification path"""
+    try:
+        async with http.post(VERIFY_URL, json={"qr": payload, "device": DEVICE_NAME,
+                                               "source": "camera"}) as response:
+            print(f"[INFO] 🔎 QR posted -> {response.status}")
+    except Exception as e:
+        print("[ERROR] QR post failed:", e)
+
+
+def qr_listener(timestamp, frame):
+    # Only spend decoder time when something moves in the lane
+    if motion.active:
+        qr.push(timestamp, frame)
+
+
+async def on_startup(app):
+    global source, recorder, motion, qr, http, mjpeg
+    loop = asyncio.get_running_loop()
+
+    def on_decode(payload):
+        if VERIFY_URL:
+            loop.call_soon_threadsafe(asyncio.ensure_future, post_qr(payload))
+
+    try:
+        # Launch the QR worker processes before the camera is opened, off the loop
+        qr = QrDecoder(on_decode, crop=lambda frame: frame[roi_slices(frame.shape)])
+        await loop.run_in_executor(None, qr.start)
+        http = ClientSession(connector=TCPConnector(ssl=False), timeout=ClientTimeout(total=5))
+        source = FrameSource()
+        mjpeg = MjpegBroadcaster(source)
+        motion = MotionDetector()
+        recorder = ClipRecorder(CLIP_DIR, encode=source.jpeg).start()
+        source.listeners.append(motion)
+        source.listeners.append(recorder.push)
+        source.listeners.append(qr_listener)
+        source.start()
+    except BaseException:
+        # e.g. no camera attached: aiohttp skips on_cleanup when startup fails,
+        # so release the workers and the session here before a restart
+        await on_cleanup(app)
+        raise
+
 
 async def on_shutdown(app):
     coros = [pc.close() for pc in pcs]
@@ -88,11 +436,37 @@ async def on_shutdown(app):
     pcs.clear()
 
 
+async def on_cleanup(app):
+    global source, recorder, motion, qr, http, mjpeg
+    if mjpeg:
+        mjpeg.close()
+        mjpeg = None
+    if source:
+        source.stop()
+        source = None
+    if qr:
+        qr.close()
+        qr = None
+    if http:
+        await http.close()
+        http = None
+    if recorder:
+        # Flushes the clip being collected; keep the join off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, recorder.close)
+        recorder = None
+    motion = None
+
+
 # --- App Setup ---
 app = web.Application()
+app.on_startup.append(on_startup)
 app.on_shutdown.append(on_shutdown)
+app.on_cleanup.append(on_cleanup)
 app.router.add_get("/", index)
 app.router.add_post("/offer", offer)
+app.router.add_post("/event", event)
+app.router.add_get("/snapshot.jpg", snapshot)
+app.router.add_get("/stream.mjpg", stream_mjpg)
 
 if __name__ == "__main__":
     print("[INFO] Starting WebRTC server on port 8080...")
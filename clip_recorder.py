@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Pre-trigger Clip Recorder
+=========================
+Keeps the last PRE_SECONDS of camera frames as JPEG bytes in a bounded
+ring buffer and, when an event arrives (presence start, verification
+failure, unlock, ...), writes a clip covering PRE_SECONDS before to
+POST_SECONDS after the event.
+
+- Frames are JPEG-encoded once, at RECORD_FPS, on the capture thread
+  (or by a shared `encode` callable, so other JPEG consumers reuse the
+  same bytes); the ring holds encoded bytes only and is capped by
+  MAX_BUFFER_BYTES, and a clip being collected is cut at MAX_CLIP_BYTES,
+  so memory use is predictable.
+- Clips are written by a background thread as one sequential write of
+  concatenated JPEGs (.mjpeg, playable with ffplay/VLC) - the frames are
+  never re-encoded - plus a .json sidecar with the frame timestamps.
+- Events that arrive while a clip is still being collected extend it
+  instead of starting a second, overlapping clip.
+- After every write the writer deletes the oldest clips until the
+  directory is under MAX_DIR_BYTES and nothing is older than MAX_CLIP_AGE,
+  so a busy gate cannot fill the SD card.
+
+Usage:
+    recorder = ClipRecorder(CLIP_DIR).start()
+    recorder.push(time.time(), bgr_frame)      # from the capture loop
+    recorder.trigger("failed", {"studentId": "123"})
+"""
+
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from kiosk_log import get_logger
+
+# ---------------- CONFIGURATION ----------------
+CLIP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clips")
+PRE_SECONDS = 5               # Footage kept before an event
+POST_SECONDS = 5              # Footage recorded after an event
+RECORD_FPS = 10               # Frames per second kept in the ring buffer
+JPEG_QUALITY = 70
+MAX_BUFFER_BYTES = 8 * 1024 * 1024   # Hard cap for the pre-trigger ring
+MAX_CLIP_SECONDS = 60         # Cap for clips extended by repeated events
+MAX_CLIP_BYTES = 16 * 1024 * 1024    # ...and for their size in memory
+MAX_DIR_BYTES = 512 * 1024 * 1024    # Clips on disk, oldest deleted first
+MAX_CLIP_AGE = 7 * 24 * 3600  # Seconds a clip is kept on disk
+# ------------------------------------------------
+
+log = get_logger("recorder")
+
+
+class _Clip:
+    def __init__(self, event, meta, event_time, start, end, frames):
+        self.events = [{"event": event, "time": event_time, **meta}]
+        self.start = start
+        self.end = end
+        self.frames = frames   # [(timestamp, jpeg bytes)]
+        self.bytes = sum(len(jpeg) for _, jpeg in frames)
+
+
+class ClipRecorder:
+    def __init__(self, directory=CLIP_DIR, pre_seconds=PRE_SECONDS, post_seconds=POST_SECONDS,
+                 fps=RECORD_FPS, quality=JPEG_QUALITY, max_bytes=MAX_BUFFER_BYTES, encode=None,
+                 max_dir_bytes=MAX_DIR_BYTES, max_age=MAX_CLIP_AGE):
+        self.directory = directory
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.interval = 1.0 / fps
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        self.encode = encode or self._encode   # fn(frame) -> JPEG bytes or None
+        self.max_bytes = max_bytes
+        self.max_dir_bytes = max_dir_bytes
+        self.max_age = max_age
+
+        self._ring = collections.deque()   # (timestamp, jpeg bytes)
+        self._ring_bytes = 0
+        self._last_pushed = 0.0
+        self._lock = threading.Lock()
+        self._active = None
+        self._pending_events = []
+        self._writes = queue.SimpleQueue()
+        self._writer = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._writer = threading.Thread(target=self._writer_loop, name="clip-writer", daemon=True)
+        self._writer.start()
+        return self
+
+    def close(self):
+        with self._lock:
+            self._finish_active()
+        self._writes.put(None)
+        if self._writer:
+            self._writer.join(timeout=10)
+
+    # ---------------- CAPTURE SIDE ----------------
+    def push(self, timestamp, frame):
+        """Add a BGR frame from the capture loop (subsampled to RECORD_FPS)"""
+        if timestamp - self._last_pushed < self.interval:
+            return
+        self._last_pushed = timestamp
+        jpeg = self.encode(frame)
+        if jpeg:
+            self.push_encoded(timestamp, jpeg)
+
+    def _encode(self, frame):
+        ok, jpeg = cv2.imencode(".jpg", frame, self.encode_params)
+        return jpeg.tobytes() if ok else None
+
+    def push_encoded(self, timestamp, jpeg):
+        """Add an already JPEG-encoded frame"""
+        with self._lock:
+            if self._pending_events:
+                self._start_clips()
+
+            self._ring.append((timestamp, jpeg))
+            self._ring_bytes += len(jpeg)
+            horizon = timestamp - self.pre_seconds
+            while self._ring and (self._ring[0][0] < horizon or self._ring_bytes > self.max_bytes):
+                self._ring_bytes -= len(self._ring.popleft()[1])
+
+            if self._active is not None:
+                self._active.frames.append((timestamp, jpeg))
+                self._active.bytes += len(jpeg)
+                if timestamp >= self._active.end or self._active.bytes >= MAX_CLIP_BYTES:
+                    self._finish_active()
+
+    # ---------------- EVENTS ----------------
+    def trigger(self, event, meta=None, event_time=None):
+        """Record a clip around `event`; safe to call from any thread.
+
+        `event_time` (unix time, default now) lets remote reporters place the
+        clip correctly even when their notification arrives late.
+        """
+        now = time.time()
+        event_time = now if event_time is None else min(event_time, now)
+        with self._lock:
+            self._pending_events.append((event_time, event, meta or {}))
+
+    def _start_clips(self):
+        for event_time, event, meta in self._pending_events:
+            clip = self._active
+            if clip is not None and event_time <= clip.end:
+                clip.events.append({"event": event, "time": event_time, **meta})
+                clip.end = min(event_time + self.post_seconds, clip.start + MAX_CLIP_SECONDS)
+                continue
+            start = event_time - self.pre_seconds
+            frames = [item for item in self._ring if item[0] >= start]
+            self._active = _Clip(event, meta, event_time, start, event_time + self.post_seconds, frames)
+            log.info("🎬 Recording clip for %s", event)
+        self._pending_events.clear()
+
+    def _finish_active(self):
+        if self._active is not None:
+            self._writes.put(self._active)
+            self._active = None
+
+    # ---------------- WRITER ----------------
+    def _writer_loop(self):
+        self._prune()
+        while True:
+            clip = self._writes.get()
+            if clip is None:
+                return
+            try:
+                self._write_clip(clip)
+            except OSError as e:
+                log.error("❌ Writing clip failed: %s", e)
+            self._prune()
+
+    def _prune(self):
+        """Delete the oldest clips until the directory is within the size and age limits"""
+        try:
+            clips = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                           for entry in os.scandir(self.directory) if entry.name.endswith(".mjpeg"))
+        except OSError as e:
+            log.warning("⚠ Cannot list clips: %s", e, every=300)
+            return
+        total = sum(size for _, size, _ in clips)
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for mtime, size, path in clips[:-1]:   # Never the clip just written
+            if total <= self.max_dir_bytes and mtime >= cutoff:
+                break
+            for name in (path, path[:-len(".mjpeg")] + ".json"):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log.warning("⚠ Cannot delete %s: %s", os.path.basename(name), e, every=300)
+            total -= size
+            removed += 1
+        if removed:
+            log.info("🧹 Deleted %d old clip(s)", removed)
+
+    def _write_clip(self, clip):
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(clip.events[0]["time"]))
+        event = "".join(c for c in str(clip.events[0]["event"]) if c.isalnum() or c in "-_")[:32]
+        base = os.path.join(self.directory, f"{stamp}-{event or 'event'}")
+        with open(base + ".mjpeg", "wb") as f:
+            f.write(b"".join(jpeg for _, jpeg in clip.frames))
+        with open(base + ".json", "w") as f:
+            json.dump({"events": clip.events,
+                       "frames": [round(ts, 3) for ts, _ in clip.frames]}, f)
+        log.info("💾 Saved clip %s.mjpeg (%d frames)", os.path.basename(base), len(clip.frames))
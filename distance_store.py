@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Distance Time-Series Store
+==========================
+Fixed-memory, in-process store for the VL53L0X distance stream so that
+THRESHOLD and AUTO_STOP_DELAY can be tuned from real traffic.
+
+- Raw readings go into a fixed-size ring (RAW_CAPACITY samples).
+- Every sample also updates running min/max/sum/count accumulators that
+  roll up into 1 s buckets and from there into 1 min buckets. Bucket k
+  lives at slot k % capacity, so range queries index buckets directly
+  and never scan raw samples.
+- Adding a sample is a handful of scalar updates (no allocation), which
+  keeps up with 30+ Hz sensors on a Pi.
+- start() moves every ring into a memory-mapped file (the rings become
+  views of the mapping, nothing is copied afterwards), so only pages
+  touched since the last flush are written back; they are flushed every
+  PERSIST_INTERVAL. Without start() (or if it fails) the store keeps
+  working in memory.
+- serve() exposes a small JSON API:
+    GET /distance?from=<unix>&to=<unix>&res=auto|raw|1s|1m
+    GET /distance/stats?window=<seconds>
+
+Usage:
+    store, server = start_history(THRESHOLD)   # store.start() + serve(store)
+    store.add(time.time(), distance)           # from the sensor loop
+    stop_history(store, server)
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from kiosk_log import get_logger
+
+# ---------------- CONFIGURATION ----------------
+STORE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "distance.ts")
+RAW_CAPACITY = 30 * 600       # 10 minutes of raw samples at 30 Hz
+SECOND_CAPACITY = 24 * 3600   # 1 day of 1 s buckets
+MINUTE_CAPACITY = 30 * 1440   # 30 days of 1 min buckets
+PERSIST_INTERVAL = 30         # Seconds between flushes of dirty pages
+MAX_POINTS = 1000             # res=auto picks the finest resolution under this
+API_HOST = "0.0.0.0"
+API_PORT = int(os.environ.get("DISTANCE_API_PORT", "8090"))
+# ------------------------------------------------
+
+log = get_logger("distance")
+
+MAGIC = b"DISTTS02"
+HEADER = struct.Struct("<8sIIIQ")   # magic, raw/second/minute capacity, raw samples written
+HEADER_SIZE = 64                    # Padded so every ring starts 8-byte aligned
+NO_DISTANCE = 0xFFFF
+
+
+class Rollup:
+    """Ring of aggregated buckets, `width` seconds each"""
+
+    FIELDS = (("key", "q"), ("min", "H"), ("max", "H"), ("sum", "d"),
+              ("count", "I"), ("valid", "I"), ("occupied", "I"))
+
+    def __init__(self, width, capacity):
+        self.width = width
+        self.capacity = capacity
+        self.key = array("q", [-1]) * capacity   # Bucket index stored in each slot
+        self.min = array("H", [NO_DISTANCE]) * capacity
+        self.max = array("H", [0]) * capacity
+        self.sum = array("d", [0.0]) * capacity
+        self.count = array("I", [0]) * capacity
+        self.valid = array("I", [0]) * capacity
+        self.occupied = array("I", [0]) * capacity
+
+    def rings(self):
+        return [(self, name) for name, _ in self.FIELDS]
+
+    def store(self, bucket, lo, hi, total, count, valid, occupied):
+        slot = bucket % self.capacity
+        self.key[slot] = bucket
+        self.min[slot] = lo
+        self.max[slot] = hi
+        self.sum[slot] = total
+        self.count[slot] = count
+        self.valid[slot] = valid
+        self.occupied[slot] = occupied
+
+    def buckets(self, start, end):
+        """Yield (bucket start time, min, max, sum, count, valid, occupied) for [start, end]"""
+        first = max(int(start // self.width), int(end // self.width) - self.capacity + 1)
+        for bucket in range(first, int(end // self.width) + 1):
+            slot = bucket % self.capacity
+            if self.key[slot] == bucket:
+                yield (bucket * self.width, self.min[slot], self.max[slot], self.sum[slot],
+                       self.count[slot], self.valid[slot], self.occupied[slot])
+
+
+class _Accumulator:
+    __slots__ = ("bucket", "min", "max", "sum", "count", "valid", "occupied")
+
+    def __init__(self):
+        self.reset(-1)
+
+    def reset(self, bucket):
+        self.bucket = bucket
+        self.min = NO_DISTANCE
+        self.max = 0
+        self.sum = 0.0
+        self.count = 0
+        self.valid = 0
+        self.occupied = 0
+
+
+class DistanceStore:
+    def __init__(self, threshold, path=STORE_FILE):
+        self.threshold = threshold
+        self.path = path
+
+        self.raw_time = array("d", [0.0]) * RAW_CAPACITY
+        self.raw_distance = array("H", [0]) * RAW_CAPACITY
+        self.written = 0              # Raw samples written since the store was created
+        self.seconds = Rollup(1, SECOND_CAPACITY)
+        self.minutes = Rollup(60, MINUTE_CAPACITY)
+        self._second = _Accumulator()
+        self._minute = _Accumulator()
+
+        self._mmap = None
+        self._views = []              # Memoryviews of the mapping, released on close
+        self._stop = threading.Event()
+        self._persister = None
+
+    # ---------------- HOT PATH ----------------
+    def add(self, timestamp, distance):
+        """Record one reading (0 = out of range / not ready).
+
+        Anything the rings cannot hold (the driver's -1 on a ranging error,
+        readings at or above NO_DISTANCE) is stored as 0, so this never throws.
+        """
+        distance = int(distance)
+        if distance <= 0 or distance >= NO_DISTANCE:
+            distance = 0
+        slot = self.written % RAW_CAPACITY
+        self.raw_time[slot] = timestamp
+        self.raw_distance[slot] = distance
+        self.written += 1
+
+        acc = self._second
+        bucket = int(timestamp)
+        if bucket != acc.bucket:
+            self._roll_second(bucket)
+        acc.count += 1
+        if distance > 0:
+            acc.valid += 1
+            acc.sum += distance
+            if distance < acc.min:
+                acc.min = distance
+            if distance > acc.max:
+                acc.max = distance
+            if distance <= self.threshold:
+                acc.occupied += 1
+
+    def _roll_second(self, bucket):
+        acc = self._second
+        if acc.count:
+            self.seconds.store(acc.bucket, acc.min, acc.max, acc.sum, acc.count, acc.valid, acc.occupied)
+            minute = self._minute
+            if acc.bucket // 60 != minute.bucket:
+                if minute.count:
+                    self.minutes.store(minute.bucket, minute.min, minute.max, minute.sum,
+                                       minute.count, minute.valid, minute.occupied)
+                minute.reset(acc.bucket // 60)
+            minute.min = min(minute.min, acc.min)
+            minute.max = max(minute.max, acc.max)
+            minute.sum += acc.sum
+            minute.count += acc.count
+            minute.valid += acc.valid
+            minute.occupied += acc.occupied
+        acc.reset(bucket)
+
+    # ---------------- QUERIES ----------------
+    def _buckets(self, rollup, start, end):
+        """Closed buckets of `rollup` in [start, end] followed by the one still filling"""
+        yield from rollup.buckets(start, end)
+        second, minute = self._second, self._minute
+        open_buckets = [second]
+        if rollup is self.minutes and second.bucket // 60 == minute.bucket:
+            open_buckets.insert(0, minute)   # Current minute = its closed seconds + the current second
+        count = sum(acc.count for acc in open_buckets)
+        t = second.bucket // rollup.width * rollup.width
+        if count and start // rollup.width * rollup.width <= t <= end:
+            yield (t, min(acc.min for acc in open_buckets), max(acc.max for acc in open_buckets),
+                   sum(acc.sum for acc in open_buckets), count,
+                   sum(acc.valid for acc in open_buckets), sum(acc.occupied for acc in open_buckets))
+
+    def _raw_range(self, start, end):
+        count = min(self.written, RAW_CAPACITY)
+        first = self.written - count
+
+        def time_at(i):
+            return self.raw_time[(first + i) % RAW_CAPACITY]
+
+        # Timestamps are monotonic within the ring: binary search the start
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if time_at(mid) < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        points = []
+        for i in range(lo, count):
+            slot = (first + i) % RAW_CAPACITY
+            if self.raw_time[slot] > end:
+                break
+            points.append([round(self.raw_time[slot], 3), self.raw_distance[slot]])
+        return points
+
+    def query(self, start, end, resolution="auto"):
+        """Points for [start, end]: raw [t, distance] or buckets [t, min, max, mean, occupancy]"""
+        span = max(0.0, end - start)
+        if resolution == "auto":
+            oldest_raw = self.raw_time[self.written % RAW_CAPACITY] if self.written >= RAW_CAPACITY else 0
+            if start >= oldest_raw and span * 30 <= MAX_POINTS:
+                resolution = "raw"
+            elif span <= MAX_POINTS:
+                resolution = "1s"
+            else:
+                resolution = "1m"
+
+        if resolution == "raw":
+            return {"resolution": "raw", "points": self._raw_range(start, end)}
+
+        rollup = self.seconds if resolution == "1s" else self.minutes
+        points = []
+        for t, lo, hi, total, count, valid, occupied in self._buckets(rollup, start, end):
+            points.append([t, lo if valid else None, hi if valid else None,
+                           round(total / valid, 1) if valid else None,
+                           round(occupied / valid, 3) if valid else 0.0])
+        return {"resolution": resolution, "points": points}
+
+    def stats(self, window):
+        """Occupancy and distance statistics for the last `window` seconds"""
+        end = time.time()
+        rollup = self.seconds if window <= SECOND_CAPACITY else self.minutes
+        lo, hi, total, count, valid, occupied, occupied_buckets = NO_DISTANCE, 0, 0.0, 0, 0, 0, 0
+        for _, b_lo, b_hi, b_total, b_count, b_valid, b_occupied in self._buckets(rollup, end - window, end):
+            count += b_count
+            valid += b_valid
+            occupied += b_occupied
+            total += b_total
+            if b_valid:
+                lo, hi = min(lo, b_lo), max(hi, b_hi)
+            if b_occupied:
+                occupied_buckets += 1
+        return {
+            "window": window,
+            "threshold": self.threshold,
+            "samples": count,
+            "valid": valid,
+            "min": lo if valid else None,
+            "max": hi if valid else None,
+            "mean": round(total / valid, 1) if valid else None,
+            "occupancy": round(occupied / valid, 3) if valid else 0.0,
+            "occupied_seconds": occupied_buckets * rollup.width,
+        }
+
+    # ---------------- PERSISTENCE ----------------
+    def _rings(self):
+        """(owner, attribute) of every ring, in file order"""
+        return [(self, "raw_time"), (self, "raw_distance")] + self.seconds.rings() + self.minutes.rings()
+
+    def start(self):
+        """Map the store file, restore its history and back every ring by the mapping"""
+        rings = [getattr(owner, name) for owner, name in self._rings()]
+        size = HEADER_SIZE + sum(len(ring) * ring.itemsize for ring in rings)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            restore = os.fstat(fd).st_size == size
+            if not restore:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, raw_cap, sec_cap, min_cap, written = HEADER.unpack_from(self._mmap, 0)
+        restore = restore and (magic, raw_cap, sec_cap, min_cap) == (
+            MAGIC, RAW_CAPACITY, SECOND_CAPACITY, MINUTE_CAPACITY)
+
+        view = memoryview(self._mmap)
+        self._views = [view]
+        offset = HEADER_SIZE
+        for (owner, name), ring in zip(self._rings(), rings):
+            nbytes = len(ring) * ring.itemsize
+            mapped = view[offset:offset + nbytes].cast(ring.typecode)
+            if not restore:
+                mapped[:] = ring   # Fresh file: start from the empty (or in-memory) ring
+            setattr(owner, name, mapped)
+            self._views.append(mapped)
+            offset += nbytes
+
+        if restore:
+            self.written = written
+            log.info("📈 Restored distance history (%d raw samples)", min(written, RAW_CAPACITY))
+        self.persist()
+
+        self._persister = threading.Thread(target=self._persist_loop, name="distance-store", daemon=True)
+        self._persister.start()
+        return self
+
+    def persist(self):
+        """Update the header and write back the pages dirtied since the last flush"""
+        HEADER.pack_into(self._mmap, 0, MAGIC, RAW_CAPACITY, SECOND_CAPACITY, MINUTE_CAPACITY, self.written)
+        self._mmap.flush()
+
+    def _persist_loop(self):
+        while not self._stop.wait(PERSIST_INTERVAL):
+            try:
+                self.persist()
+            except Exception as e:
+                log.warning("⚠ Persisting distance history failed: %s", e, every=300)
+
+    def close(self):
+        """Flush and unmap; serve() must be shut down first"""
+        self._stop.set()
+        if self._mmap is not None:
+            if self._persister:
+                self._persister.join(timeout=5)
+            self.persist()
+            for view in reversed(self._views):
+                view.release()
+            self._views = []
+            self._mmap.close()
+            self._mmap = None
+
+
+# ---------------- QUERY API ----------------
+def serve(store, host=API_HOST, port=API_PORT):
+    """Serve the JSON query API on a daemon thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                if url.path == "/distance":
+                    end = float(query.get("to", time.time()))
+                    start = float(query.get("from", end - 60))
+                    body = store.query(start, end, query.get("res", "auto"))
+                elif url.path == "/distance/stats":
+                    body = store.stats(float(query.get("window", 3600)))
+                else:
+                    self.send_error(404)
+                    return
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            log.debug("API %s", format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="distance-api", daemon=True).start()
+    log.info("📈 Distance API on %s:%s", host, port)
+    return server
+
+
+def start_history(threshold, port=API_PORT):
+    """Start a persisted store and its query API; returns (store, server).
+
+    Both are optional for the sensor loops: if the store file cannot be
+    mapped the history stays in memory, and if the API port is taken
+    server is None and sensing continues without it.
+    """
+    store = DistanceStore(threshold)
+    try:
+        store.start()
+    except Exception as e:
+        log.warning("⚠ Distance history kept in memory only: %s", e)
+    try:
+        server = serve(store, port=port)
+    except Exception as e:
+        log.warning("⚠ Distance API not available: %s", e)
+        server = None
+    return store, server
+
+
+def stop_history(store, server):
+    """Undo start_history(); either argument may be None"""
+    if server:
+        server.shutdown()
+        server.server_close()
+    if store:
+        store.close()
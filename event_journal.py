@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Durable Local Event Journal
+===========================
+Append-only on-disk journal for access and presence events with a
+background uploader, shared by LED-flash.py, LED-flash2.py and
+turnstile-control.py.
+
+- append() never blocks: records go onto a queue and a writer thread
+  batches them into the active segment, with one fsync per batch.
+- Segments are sealed when they reach SEGMENT_BYTES or SEGMENT_MAX_AGE
+  and are then gzip-compressed and POSTed to the server by the uploader
+  thread. A segment is deleted only after a 2xx reply (at-least-once).
+- Segments left behind by a crash are recovered (torn tail truncated)
+  and uploaded on the next start.
+- Every journal owns its directory (one subdirectory of JOURNAL_DIR per
+  component): recovery seals any .log segment it finds and the uploader
+  posts every .seg under its own device name. A lock file stops a second
+  journal from opening the same directory.
+- A failed write (disk full, read-only SD card) is cut off the active
+  segment, which is sealed; the records are kept and retried in a fresh
+  segment (up to MAX_PENDING).
+- open_journal() falls back to a NullJournal when the journal cannot
+  start, so callers keep running without an audit trail.
+
+Record format (little endian), repeated until end of file:
+
+    u32 length | u32 crc32 | f64 unix time | u8 kind | JSON payload
+
+`length` covers time, kind and payload; `crc32` is over the same bytes.
+
+Usage:
+    journal = open_journal(os.path.join(JOURNAL_DIR, "sensor"), "https://<server>/api/events", "device1")
+    journal.append("presence", {"action": "start_camera"})
+    journal.close()
+"""
+
+import fcntl
+import glob
+import gzip
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from kiosk_log import get_logger
+
+# ---------------- CONFIGURATION ----------------
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal")
+SEGMENT_BYTES = 256 * 1024    # Seal the active segment at this size
+SEGMENT_MAX_AGE = 30          # ...or after this many seconds
+BATCH_WINDOW = 0.05           # Seconds the writer waits to gather a batch
+UPLOAD_INTERVAL = 5           # Seconds between upload passes
+UPLOAD_RETRY_MAX = 300        # Max backoff between failed uploads (seconds)
+WRITE_RETRY_DELAY = 1         # Seconds between attempts after a failed write
+MAX_PENDING = 10000           # Unwritten records kept for retry before the oldest are dropped
+# ------------------------------------------------
+
+log = get_logger("journal")
+
+HEADER = struct.Struct("<II")
+BODY_HEADER = struct.Struct("<dB")
+
+# Compact kind codes; unknown kinds are stored as 0 with the name in the payload
+EVENT_KINDS = {
+    "presence": 1,
+    "access": 2,
+    "failed": 3,
+    "lock": 4,
+}
+
+
+def encode_record(timestamp, kind, payload):
+    """Encode one journal record"""
+    code = EVENT_KINDS.get(kind, 0)
+    if code == 0:
+        payload = dict(payload, kind=kind)
+    body = BODY_HEADER.pack(timestamp, code) + json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def iter_records(data):
+    """Yield (offset_after_record, timestamp, kind_code, payload) for valid records"""
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        body = data[start:start + length]
+        if len(body) < length or length < BODY_HEADER.size or zlib.crc32(body) != crc:
+            return  # Torn or corrupt tail
+        timestamp, code = BODY_HEADER.unpack_from(body)
+        offset = start + length
+        yield offset, timestamp, code, json.loads(body[BODY_HEADER.size:])
+
+
+class NullJournal:
+    """Stand-in used while no journal is running: events are dropped"""
+
+    def append(self, kind, payload=None, timestamp=None):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_journal(directory, upload_url, device):
+    """Start an EventJournal, or return a NullJournal if it cannot start.
+
+    The journal is an audit trail, so a read-only or full SD card (or a
+    directory still locked by another process) must not stop the gate or
+    the sensor loop.
+    """
+    try:
+        return EventJournal(directory, upload_url, device).start()
+    except Exception as e:
+        log.error("❌ Journal unavailable (%s), events are not recorded", e)
+        return NullJournal()
+
+
+class EventJournal:
+    def __init__(self, directory, upload_url, device, verify=False):
+        self.directory = directory
+        self.upload_url = upload_url
+        self.device = device
+        self.verify = verify
+
+        self._queue = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self._file = None
+        self._file_path = None
+        self._file_opened = 0.0
+        self._batch_start = 0         # Segment offset before the batch being written
+        self._writer = None
+        self._uploader = None
+        self._lock_file = None
+
+    # ---------------- PUBLIC API ----------------
+    def start(self):
+        """Recover old segments and start the writer and uploader threads"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, ".lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(f"Journal directory {self.directory} is already in use")
+        try:
+            self._recover()
+        except Exception:
+            self._lock_file.close()
+            self._lock_file = None
+            raise
+        self._writer = threading.Thread(target=self._writer_loop, name="journal-writer", daemon=True)
+        self._uploader = threading.Thread(target=self._uploader_loop, name="journal-uploader", daemon=True)
+        self._writer.start()
+        self._uploader.start()
+        return self
+
+    def append(self, kind, payload=None, timestamp=None):
+        """Queue an event for the journal; never blocks the caller"""
+        self._queue.put((timestamp or time.time(), kind, payload or {}))
+
+    def close(self):
+        """Flush pending records, seal the active segment and stop threads"""
+        self._stop.set()
+        self._queue.put(None)  # Wake the writer
+        if self._writer:
+            self._writer.join(timeout=5)
+        if self._uploader:
+            self._uploader.join(timeout=5)
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # ---------------- WRITER ----------------
+    def _segment_paths(self, suffix):
+        return sorted(glob.glob(os.path.join(self.directory, f"seg-*{suffix}")))
+
+    def _recover(self):
+        """Truncate torn tails of leftover active segments and seal them"""
+        for path in self._segment_paths(".log"):
+            with open(path, "rb") as f:
+                data = f.read()
+            valid = 0
+            for valid, _, _, _ in iter_records(data):
+                pass
+            if valid == 0:
+                os.remove(path)
+                continue
+            if valid < len(data):
+                log.warning("⚠ Journal: truncating torn tail of %s", os.path.basename(path))
+                with open(path, "r+b") as f:
+                    f.truncate(valid)
+            os.replace(path, path[:-len(".log")] + ".seg")
+
+    def _open_segment(self):
+        self._file_path = os.path.join(self.directory, f"seg-{time.time_ns():020d}.log")
+        self._file = open(self._file_path, "ab")
+        self._file_opened = time.monotonic()
+        self._batch_start = 0
+
+    def _seal_segment(self):
+        if not self._file:
+            return
+        file, self._file = self._file, None
+        try:
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+        os.replace(self._file_path, self._file_path[:-len(".log")] + ".seg")
+
+    def _abandon_segment(self):
+        """Cut a failed batch off the active segment and seal what was written before it"""
+        file, self._file = self._file, None
+        if file is None:
+            return
+        try:
+            file.close()
+        except OSError:
+            pass
+        try:
+            if self._batch_start:
+                os.truncate(self._file_path, self._batch_start)
+                os.replace(self._file_path, self._file_path[:-len(".log")] + ".seg")
+            else:
+                os.remove(self._file_path)
+        except OSError as e:
+            log.warning("⚠ Journal: could not seal %s (%s), recovering it on next start",
+                        os.path.basename(self._file_path), e)
+
+    def _write_batch(self, records):
+        if not self._file:
+            self._open_segment()
+        self._batch_start = self._file.tell()
+        self._file.write(b"".join(records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    @staticmethod
+    def _encode_into(pending, item):
+        try:
+            pending.append(encode_record(*item))
+        except (TypeError, ValueError) as e:
+            log.error("❌ Journal: dropping unencodable %s record (%s)", item[1], e)
+
+    def _writer_loop(self):
+        pending = []   # Encoded records not yet fsynced, oldest first
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = False
+
+            if item:
+                self._encode_into(pending, item)
+                # Gather whatever else arrives within the batch window
+                deadline = time.monotonic() + BATCH_WINDOW
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        break
+                    self._encode_into(pending, item)
+
+            if len(pending) > MAX_PENDING:
+                log.error("❌ Journal: dropping %d unwritten record(s)", len(pending) - MAX_PENDING, every=60)
+                del pending[:-MAX_PENDING]
+
+            failed = False
+            if pending:
+                try:
+                    self._write_batch(pending)
+                    pending = []
+                except OSError as e:
+                    failed = True
+                    log.error("❌ Journal write failed (%s), keeping %d record(s) for retry",
+                              e, len(pending), every=30)
+                    self._abandon_segment()
+
+            if self._file and (self._file.tell() >= SEGMENT_BYTES
+                               or time.monotonic() - self._file_opened >= SEGMENT_MAX_AGE):
+                try:
+                    self._seal_segment()
+                except OSError as e:
+                    log.warning("⚠ Journal: sealing %s failed (%s), recovering it on next start",
+                                os.path.basename(self._file_path), e, every=30)
+
+            if self._stop.is_set() and self._queue.empty():
+                if pending:
+                    log.error("❌ Journal: %d record(s) lost on shutdown", len(pending))
+                try:
+                    self._seal_segment()
+                except OSError as e:
+                    log.warning("⚠ Journal: sealing %s failed (%s), recovering it on next start",
+                                os.path.basename(self._file_path), e)
+                return
+
+            if failed:
+                self._stop.wait(WRITE_RETRY_DELAY)
+
+    # ---------------- UPLOADER ----------------
+    def _upload_segment(self, path):
+        import requests  # Only the uploader thread needs it
+        with open(path, "rb") as f:
+            body = gzip.compress(f.read())
+        response = requests.post(
+            self.upload_url,
+            data=body,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Encoding": "gzip",
+                "X-Device": self.device,
+                "X-Segment": os.path.basename(path),
+            },
+            verify=self.verify,
+            timeout=10
+        )
+        response.raise_for_status()
+
+    def _uploader_loop(self):
+        backoff = UPLOAD_INTERVAL
+        while not self._stop.wait(backoff):
+            try:
+                for path in self._segment_paths(".seg"):
+                    self._upload_segment(path)
+                    os.remove(path)  # Only after the server acknowledged it
+                backoff = UPLOAD_INTERVAL
+            except Exception as e:
+                backoff = min(backoff * 2, UPLOAD_RETRY_MAX)
+                log.warning("⚠ Journal upload failed (%s), retrying in %ss", e, backoff, every=60)
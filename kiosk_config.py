@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Kiosk Configuration
+===================
+Headless configuration shared by the sensor apps, the turnstile
+controller and the kiosk supervisor, so unattended kiosks never need
+the tkinter prompt.
+
+Values are merged in this order (later wins):
+  1. defaults passed by the script
+  2. JSON config file: $KIOSK_CONFIG or kiosk.json next to the scripts
+  3. environment variables: KIOSK_<KEY>, e.g. KIOSK_SERVER_IP
+  4. command line: --server-ip 172.27.44.17 --device-name device1
+
+Example kiosk.json:
+    {"server_ip": "172.27.44.17", "device_name": "device1", "threshold": 600}
+
+Startup time is measured from the first line of the calling script
+(pass its time.perf_counter() value) and checked against a budget.
+"""
+
+import argparse
+import json
+import os
+import time
+
+from kiosk_log import get_logger
+
+# ---------------- CONFIGURATION ----------------
+CONFIG_FILE = os.environ.get(
+    "KIOSK_CONFIG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "kiosk.json"))
+STARTUP_BUDGET = float(os.environ.get("KIOSK_STARTUP_BUDGET", "1.0"))  # Seconds
+# ------------------------------------------------
+
+log = get_logger("config")
+
+
+def _coerce(value, default):
+    """Convert an env/CLI string to the type of its default"""
+    if isinstance(default, bool):
+        return str(value).lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def load_config(defaults, argv=None, description=None):
+    """Merge defaults, config file, environment and CLI into one dict"""
+    config = dict(defaults)
+
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, "r") as f:
+            config.update((k, v) for k, v in json.load(f).items() if k in defaults)
+
+    for key, default in defaults.items():
+        value = os.environ.get(f"KIOSK_{key.upper()}")
+        if value is not None:
+            config[key] = _coerce(value, default)
+
+    parser = argparse.ArgumentParser(description=description)
+    for key, default in defaults.items():
+        flag = "--" + key.replace("_", "-")
+        if isinstance(default, bool):
+            parser.add_argument(flag, dest=key, action=argparse.BooleanOptionalAction, default=None)
+        else:
+            parser.add_argument(flag, dest=key, default=None,
+                                type=type(default) if default is not None else str)
+    args, _ = parser.parse_known_args(argv)
+    config.update((k, v) for k, v in vars(args).items() if v is not None)
+    return config
+
+
+def startup_report(name, t0, budget=STARTUP_BUDGET):
+    """Log time since `t0` (script start) and warn when over the budget"""
+    elapsed = time.perf_counter() - t0
+    if elapsed > budget:
+        log.warning("⏱️ %s startup took %.3fs (budget %.3fs)", name, elapsed, budget)
+    else:
+        log.info("⏱️ %s startup took %.3fs (budget %.3fs)", name, elapsed, budget)
+    return elapsed
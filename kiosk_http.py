@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP Helpers
+===================
+HTTP helpers shared by the sensor apps, the turnstile controller and
+the kiosk supervisor.
+
+- new_session() imports requests on first use (it is slow to import on
+  a Pi, so callers create the session off their hot path) and silences
+  the warnings for the kiosk's self-signed certificates.
+- notify_camera() asks the camera server to record a clip around an
+  event. It is fire-and-forget: the POST runs on a daemon thread and a
+  failure is only logged, so the caller never waits for the camera.
+
+Usage:
+    http = new_session()
+    notify_camera("http://127.0.0.1:8080/event", lambda: http, "unlock", "device1", {"studentId": "123"})
+"""
+
+import threading
+import time
+
+from kiosk_log import get_logger
+
+# ---------------- CONFIGURATION ----------------
+CAMERA_EVENT_TIMEOUT = 2      # Seconds before a camera event POST is given up
+# ------------------------------------------------
+
+log = get_logger("http")
+
+
+def new_session():
+    """Return a requests.Session for the kiosk's self-signed HTTPS servers"""
+    import requests
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return requests.Session()
+
+
+def notify_camera(url, get_session, event, device, meta=None):
+    """Ask the camera server at `url` to record a clip around `event`.
+
+    `get_session` returns the session to post with; it is called on the
+    posting thread, so a lazily created session is never built on the
+    caller's thread. Does nothing when `url` is empty.
+    """
+    if not url:
+        return
+    payload = dict(meta or {}, event=event, time=time.time(), device=device)
+
+    def post():
+        try:
+            get_session().post(url, json=payload, verify=False, timeout=CAMERA_EVENT_TIMEOUT)
+        except Exception as e:
+            log.warning("⚠ Camera event %s not delivered: %s", event, e, every=60)
+
+    threading.Thread(target=post, name="camera-event", daemon=True).start()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Shared Logging and Tracing
+==========================
+Low-overhead replacement for the hot-path print() calls in the sensor
+loops, the turnstile SSE handler and the event journal.
+
+- Level filtering happens before anything else; arguments are only
+  formatted later, on the flusher thread.
+- Records go into an in-memory ring buffer (collections.deque appends
+  are atomic, so producers never take a lock). When the buffer is full
+  the oldest unflushed records are dropped instead of blocking.
+- A background thread drains the buffer every FLUSH_INTERVAL into a
+  rotating log file (and stdout when KIOSK_LOG_CONSOLE=1). While the file
+  cannot be opened or written (disk full, read-only SD card) records go
+  to stderr instead and the file is reopened every SINK_RETRY_INTERVAL.
+- `every=` rate-limits a repeated message: it is emitted at most once
+  per interval, with a count of the suppressed repeats.
+- Trace spans (sensor read, trigger dispatch, SSE handling, GPIO
+  actuation) cost a flag check when disabled. Enable with
+  KIOSK_TRACE=1, set_tracing(True) or by sending SIGUSR2 to toggle.
+
+Usage:
+    from kiosk_log import get_logger, span
+    log = get_logger("sensor")
+    log.debug("Distance: %s mm", distance)
+    log.warning("Sensor read error: %s", e, every=5)
+    with span("sensor_read"):
+        distance = sensor.get_distance()
+"""
+
+import atexit
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+# ---------------- CONFIGURATION ----------------
+LOG_LEVEL = os.environ.get("KIOSK_LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get(
+    "KIOSK_LOG_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "kiosk.log"))
+LOG_CONSOLE = os.environ.get("KIOSK_LOG_CONSOLE", "0") == "1"   # Opt-in: keeps records off the journald pipe
+LOG_MAX_BYTES = 1024 * 1024   # Rotate the log file at this size
+LOG_BACKUPS = 3               # Rotated files to keep (kiosk.log.1 ... .3)
+RING_SIZE = 4096              # Records buffered between flushes
+FLUSH_INTERVAL = 0.5          # Seconds between flushes
+SINK_RETRY_INTERVAL = 30      # Seconds between attempts to reopen a failed log file
+# ------------------------------------------------
+
+TRACE = 5
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {TRACE: "TRACE", DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARN", ERROR: "ERROR"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+LEVELS["WARNING"] = WARNING
+
+_level = LEVELS.get(LOG_LEVEL, INFO)
+_tracing = os.environ.get("KIOSK_TRACE", "0") == "1"
+_ring = collections.deque(maxlen=RING_SIZE)
+_repeats = {}                 # (logger, template) -> [last emitted, suppressed count]
+_loggers = {}
+_flusher = None
+_sink = None
+_flusher_lock = threading.Lock()
+_wake = threading.Event()
+
+
+class Logger:
+    def __init__(self, name):
+        self.name = name
+
+    def _log(self, level, msg, args, every):
+        if level < _level:
+            return
+        if every is not None:
+            now = time.monotonic()
+            key = (self.name, msg)
+            entry = _repeats.get(key)
+            if entry is not None and now - entry[0] < every:
+                entry[1] += 1
+                return
+            if entry is not None and entry[1]:
+                msg += f" (repeated {entry[1]} more times)"
+            _repeats[key] = [now, 0]
+        _ring.append((time.time(), level, self.name, msg, args))
+
+    def debug(self, msg, *args, every=None):
+        self._log(DEBUG, msg, args, every)
+
+    def info(self, msg, *args, every=None):
+        self._log(INFO, msg, args, every)
+
+    def warning(self, msg, *args, every=None):
+        self._log(WARNING, msg, args, every)
+
+    def error(self, msg, *args, every=None):
+        self._log(ERROR, msg, args, every)
+
+    def is_enabled(self, level):
+        return level >= _level
+
+
+def get_logger(name):
+    """Return the shared logger for `name`, starting the flusher on first use"""
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers.setdefault(name, Logger(name))
+        _ensure_flusher()
+    return logger
+
+
+def set_level(level):
+    """Change the minimum level at runtime ("DEBUG", "INFO", ... or a number)"""
+    global _level
+    _level = LEVELS[level.upper()] if isinstance(level, str) else level
+
+
+# ---------------- TRACING ----------------
+class _Span:
+    __slots__ = ("name", "fields", "start")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        status = "error" if exc_type else "ok"
+        _ring.append((time.time(), TRACE, "trace", "span %s %.3f ms %s %s",
+                      (self.name, elapsed_ms, status, self.fields)))
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **fields):
+    """Time a block as a trace span; a no-op unless tracing is enabled"""
+    if not _tracing:
+        return _NO_SPAN
+    _ensure_flusher()
+    return _Span(name, fields)
+
+
+def set_tracing(enabled):
+    """Switch trace spans on or off at runtime"""
+    global _tracing
+    _tracing = bool(enabled)
+
+
+def _toggle_tracing(signum, frame):
+    set_tracing(not _tracing)
+    get_logger("trace").info("Tracing %s", "enabled" if _tracing else "disabled")
+
+
+try:
+    signal.signal(signal.SIGUSR2, _toggle_tracing)
+except (ValueError, AttributeError):
+    pass  # Not in the main thread, or no SIGUSR2 on this platform
+
+
+# ---------------- FLUSHER ----------------
+class _RotatingFile:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, text):
+        self.file.write(text)
+        self.file.flush()
+        if self.file.tell() >= LOG_MAX_BYTES:
+            try:
+                self._rotate()
+            except OSError as e:
+                # The records are written; rotation is retried on the next write
+                sys.stderr.write(f"kiosk_log: rotating {self.path} failed ({e})\n")
+
+    def _rotate(self):
+        self.file.close()
+        try:
+            for index in range(LOG_BACKUPS - 1, 0, -1):
+                older = f"{self.path}.{index}"
+                if os.path.exists(older):
+                    os.replace(older, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        finally:
+            self.file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+
+def _format(record):
+    timestamp, level, name, msg, args = record
+    if args:
+        try:
+            msg = msg % args
+        except (TypeError, ValueError):
+            msg = f"{msg} {args}"
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+    return f"{stamp}.{int(timestamp * 1000) % 1000:03d} {LEVEL_NAMES[level]:<5} [{name}] {msg}\n"
+
+
+def flush(sink=None):
+    """Format and write every buffered record to `sink` and the console.
+
+    Records that do not reach a sink (none given, or the write failed) go to
+    stderr unless they are already echoed to the console. A sink that fails
+    is closed and dropped; the flusher reopens the log file later.
+    """
+    global _sink
+    lines = []
+    while True:
+        try:
+            lines.append(_format(_ring.popleft()))
+        except IndexError:
+            break
+    if not lines:
+        return
+    text = "".join(lines)
+    written = False
+    if sink is not None:
+        try:
+            sink.write(text)
+            written = True
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"kiosk_log: writing {sink.path} failed ({e}), logging to stderr\n")
+            sink.close()
+            if sink is _sink:
+                _sink = None
+    if LOG_CONSOLE:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    elif not written:
+        sys.stderr.write(text)
+        sys.stderr.flush()
+
+
+def _open_sink():
+    global _sink
+    try:
+        _sink = _RotatingFile(LOG_FILE)
+    except OSError as e:
+        sys.stderr.write(f"kiosk_log: cannot open {LOG_FILE} ({e}), logging to stderr, "
+                         f"retrying every {SINK_RETRY_INTERVAL}s\n")
+
+
+def _flusher_loop():
+    retry_at = 0.0
+    while True:
+        if _sink is None and time.monotonic() >= retry_at:
+            _open_sink()
+            retry_at = time.monotonic() + SINK_RETRY_INTERVAL
+        _wake.wait(FLUSH_INTERVAL)
+        _wake.clear()
+        try:
+            flush(_sink)
+        except Exception as e:
+            # Never let the flusher die: every later record would be lost
+            sys.stderr.write(f"kiosk_log: flush failed ({e})\n")
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flusher_loop, name="kiosk-log", daemon=True)
+            _flusher.start()
+            atexit.register(_flush_at_exit)
+
+
+def _flush_at_exit():
+    # Write out whatever is still buffered so shutdown messages are not lost
+    flush(_sink)
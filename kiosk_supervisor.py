@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Kiosk Supervisor
+================
+Runs the kiosk components in ONE Python process instead of separate
+interpreters started by hand and from start-sensor.sh:
+
+- sensor     VL53L0X presence loop (LED-flash2.py)
+- turnstile  SSE-driven turnstile controller (turnstile-control.py)
+- camera     WebRTC camera server (adaptive_camera.py)
+- plc        S7 PLC gateway (plc_gateway.py)
+
+Components share one GPIO chip handle (pins are claimed through the
+supervisor, so two components can no longer both drive GPIO 17; with
+the turnstile enabled the sensor LED moves to GPIO 24), one
+I2C ownership table and one HTTP session. Each component is imported
+only when it is enabled, so cv2/aiortc are never loaded on a sensor-only
+kiosk. Crashed components are restarted with exponential backoff, and a
+health report is logged and written to logs/health.json periodically.
+The kiosk Chromium is launched once by the supervisor, never again on a
+service restart.
+
+Usage:
+    python3 kiosk_supervisor.py --server-ip 172.27.44.17 --device device1 sensor
+    sudo python3 kiosk_supervisor.py --server-ip 172.27.44.17 turnstile camera
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from kiosk_config import load_config
+from kiosk_log import get_logger
+
+# ---------------- CONFIGURATION ----------------
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+HEALTH_FILE = os.path.join(PROJECT_DIR, "logs", "health.json")
+HEALTH_INTERVAL = 30          # Seconds between health reports
+RESTART_BACKOFF = 1           # First restart delay (seconds)
+RESTART_BACKOFF_MAX = 60      # Max restart delay (seconds)
+STABLE_AFTER = 60             # Uptime after which the backoff resets
+CAMERA_PORT = 8080
+CAMERA_EVENT_URL = f"http://127.0.0.1:{CAMERA_PORT}/event"   # Sensor/turnstile clip triggers
+SENSOR_I2C = (1, 0x29)        # VL53L0X bus and address
+# Both scripts default to GPIO 17 (sensor LED / turnstile solenoid). When
+# they run together the sensor LED moves here; set sensor_led_pin in
+# kiosk.json (or --sensor-led-pin) to pick another pin.
+SENSOR_LED_PIN_WITH_TURNSTILE = 24
+# ------------------------------------------------
+
+log = get_logger("supervisor")
+
+
+class ResourceConflict(Exception):
+    """A GPIO pin or I2C device is already owned by another component"""
+
+
+def load_module(filename, name):
+    """Import a project script by file name (several have dashes in them)"""
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(PROJECT_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    return module
+
+
+# ---------------- SHARED RESOURCES ----------------
+class Resources:
+    """GPIO/I2C ownership and the shared HTTP session"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chip = None
+        self._pins = {}   # pin -> owner
+        self._i2c = {}    # (bus, address) -> owner
+        self._session = None
+
+    def chip(self):
+        with self._lock:
+            if self._chip is None:
+                import lgpio
+                self._chip = lgpio.gpiochip_open(0)
+            return self._chip
+
+    def claim_outputs(self, pins, owner):
+        """Claim output pins for `owner`; raises ResourceConflict on a clash"""
+        import lgpio
+        chip = self.chip()
+        with self._lock:
+            for pin in pins:
+                current = self._pins.get(pin)
+                if current is not None and current != owner:
+                    raise ResourceConflict(f"GPIO {pin} is already owned by {current}")
+            for pin in pins:
+                if pin not in self._pins:
+                    lgpio.gpio_claim_output(chip, pin)
+                    self._pins[pin] = owner
+
+    def claim_i2c(self, bus, address, owner):
+        with self._lock:
+            current = self._i2c.setdefault((bus, address), owner)
+            if current != owner:
+                raise ResourceConflict(f"I2C {bus}:{address:#04x} is already owned by {current}")
+
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                from kiosk_http import new_session
+                self._session = new_session()
+                self._session.verify = False
+            return self._session
+
+    def close(self):
+        if self._chip is not None:
+            import lgpio
+            for pin in self._pins:
+                lgpio.gpio_write(self._chip, pin, 0)
+            lgpio.gpiochip_close(self._chip)
+            self._chip = None
+        if self._session is not None:
+            self._session.close()
+
+
+async def run_in_thread(func, *args):
+    """Run a blocking component loop in a daemon thread and await its result"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, None, e)
+        else:
+            loop.call_soon_threadsafe(settle, result, None)
+
+    threading.Thread(target=target, name=getattr(func, "__name__", "service"), daemon=True).start()
+    return await future
+
+
+# ---------------- SERVICES ----------------
+class Service:
+    def __init__(self, name, run, stop=None):
+        self.name = name
+        self._run = run        # async fn(supervisor)
+        self._stop = stop      # fn() asking a blocking loop to exit
+        self.state = "stopped"
+        self.restarts = 0
+        self.last_error = None
+        self.started_at = None
+
+    def stop(self):
+        if self._stop:
+            try:
+                self._stop()
+            except Exception as e:
+                log.warning("⚠ Stopping %s failed: %s", self.name, e)
+
+    def health(self):
+        uptime = time.monotonic() - self.started_at if self.started_at and self.state == "running" else 0
+        return {"state": self.state, "restarts": self.restarts,
+                "uptime": round(uptime, 1), "last_error": self.last_error}
+
+    async def supervise(self, supervisor):
+        backoff = RESTART_BACKOFF
+        while not supervisor.stopping:
+            self.state = "running"
+            self.started_at = time.monotonic()
+            log.info("▶ Starting %s", self.name)
+            try:
+                await self._run(supervisor)
+                if supervisor.stopping:
+                    break
+                raise RuntimeError("exited unexpectedly")
+            except ResourceConflict as e:
+                # Configuration problem: restarting would only fail again
+                self.state = "failed"
+                self.last_error = str(e)
+                log.error("❌ %s not started: %s", self.name, e)
+                return
+            except asyncio.CancelledError:
+                self.stop()
+                raise
+            except Exception as e:
+                if supervisor.stopping:
+                    break
+                self.restarts += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                log.error("❌ %s crashed (%s), restarting in %ss", self.name, self.last_error, backoff)
+
+            if time.monotonic() - self.started_at >= STABLE_AFTER:
+                backoff = RESTART_BACKOFF
+            self.state = "restarting"
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+        self.state = "stopped"
+
+
+def sensor_service(args):
+    module = None
+
+    async def run(supervisor):
+        nonlocal module
+        module = load_module("LED-flash2.py", "led_flash2")
+        module.load_sensor_config(argv=[])   # port, threshold, ... from kiosk.json / KIOSK_*
+        if args.sensor_led_pin:
+            module.LED_PIN = args.sensor_led_pin
+        elif "turnstile" in args.services:
+            module.LED_PIN = SENSOR_LED_PIN_WITH_TURNSTILE
+        supervisor.resources.claim_outputs([module.LED_PIN], "sensor")
+        supervisor.resources.claim_i2c(*SENSOR_I2C, "sensor")
+        module.http = supervisor.resources.session()
+        if "camera" in args.services and not module.CAMERA_EVENT_URL:
+            module.CAMERA_EVENT_URL = CAMERA_EVENT_URL
+        module.configure(args.server_ip, args.device)
+        if "turnstile" not in args.services:
+            supervisor.launch_browser(module.launch_chromium)
+        await run_in_thread(module.start_sensor_loop, supervisor.resources.chip())
+
+    return Service("sensor", run, stop=lambda: module and module.stop())
+
+
+def turnstile_service(args):
+    module = None
+
+    async def run(supervisor):
+        nonlocal module
+        module = load_module("turnstile-control.py", "turnstile_control")
+        config = load_config({
+            "port": module.PORT,
+            "camera_event_url": CAMERA_EVENT_URL if "camera" in args.services else module.CAMERA_EVENT_URL,
+        }, argv=[])
+        module.apply_config(dict(config, server_ip=args.server_ip, device_name=args.device))
+        module.load_lanes()
+        supervisor.resources.claim_outputs(module.lane_pins(), "turnstile")
+        module.http = supervisor.resources.session()
+        supervisor.launch_browser(module.launch_chromium)
+        await run_in_thread(module.start_program, supervisor.resources.chip(), False)
+
+    return Service("turnstile", run, stop=lambda: module and module.stop())
+
+
+def camera_service(args):
+    async def run(supervisor):
+        from aiohttp import web
+        module = load_module("adaptive_camera.py", "adaptive_camera")
+        runner = web.AppRunner(module.app)
+        try:
+            await runner.setup()   # Runs on_startup (QR workers, camera)
+            await web.TCPSite(runner, port=CAMERA_PORT).start()
+            log.info("📷 Camera server on port %s", CAMERA_PORT)
+            await supervisor.stopped.wait()
+        finally:
+            await runner.cleanup()
+
+    return Service("camera", run)
+
+
+def plc_service(args):
+    async def run(supervisor):
+        module = load_module("plc_gateway.py", "plc_gateway")
+        await run_in_thread(module.start_gateway)
+
+    return Service("plc", run)
+
+
+SERVICE_FACTORIES = {
+    "sensor": sensor_service,
+    "turnstile": turnstile_service,
+    "camera": camera_service,
+    "plc": plc_service,
+}
+
+
+# ---------------- SUPERVISOR ----------------
+class Supervisor:
+    def __init__(self, services):
+        self.services = services
+        self.resources = Resources()
+        self.stopping = False
+        self.stopped = None
+        self.browser_launched = False
+
+    def launch_browser(self, launch):
+        """Start the kiosk Chromium once; crash-restarts of a service must not stack windows"""
+        if self.browser_launched:
+            return
+        self.browser_launched = True
+        try:
+            launch()
+        except OSError as e:
+            log.error("❌ Chromium launch failed: %s", e)
+
+    def health(self):
+        return {"time": time.time(), "services": {s.name: s.health() for s in self.services}}
+
+    def report_health(self):
+        report = self.health()
+        summary = ", ".join(f"{name}={h['state']}({h['restarts']})" for name, h in report["services"].items())
+        log.info("🩺 Health: %s", summary)
+        try:
+            os.makedirs(os.path.dirname(HEALTH_FILE), exist_ok=True)
+            with open(HEALTH_FILE + ".tmp", "w") as f:
+                json.dump(report, f)
+            os.replace(HEALTH_FILE + ".tmp", HEALTH_FILE)
+        except OSError as e:
+            log.warning("⚠ Cannot write %s: %s", HEALTH_FILE, e, every=300)
+
+    def request_stop(self):
+        if self.stopping:
+            return
+        log.info("👋 Shutting down...")
+        self.stopping = True
+        for service in self.services:
+            service.stop()
+        self.stopped.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.request_stop)
+
+        tasks = [asyncio.create_task(s.supervise(self), name=s.name) for s in self.services]
+        try:
+            while not self.stopping:
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), HEALTH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.report_health()
+            # Give the blocking loops a moment to notice the stop request
+            await asyncio.wait(tasks, timeout=5)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.resources.close()
+
+
+def main():
+    # kiosk.json / KIOSK_* environment provide the defaults for the flags
+    config = load_config({"server_ip": "172.27.44.17", "device_name": "device1",
+                          "sensor_led_pin": 0}, argv=[])
+
+    parser = argparse.ArgumentParser(description="Run kiosk components in one process")
+    parser.add_argument("services", nargs="+", choices=sorted(SERVICE_FACTORIES))
+    parser.add_argument("--server-ip", default=config["server_ip"], help="SvelteKit server IP (sensor and turnstile)")
+    parser.add_argument("--device", default=config["device_name"], help="Device name (sensor and turnstile)")
+    parser.add_argument("--sensor-led-pin", type=int, default=config["sensor_led_pin"],
+                        help=f"Sensor LED GPIO (default 17, or {SENSOR_LED_PIN_WITH_TURNSTILE} with the turnstile)")
+    args = parser.parse_args()
+
+    services = [SERVICE_FACTORIES[name](args) for name in dict.fromkeys(args.services)]
+    log.info("🚀 Kiosk supervisor starting: %s", ", ".join(s.name for s in services))
+    asyncio.run(Supervisor(services).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,292 @@
 #!/usr/bin/env python3
+"""
+S7 PLC Gateway
+==============
+Forwards student S7 (ISO-on-TCP) connections to the lab's trainer PLCs.
+One gateway process serves every PLC: each client is routed to a target
+PLC by, in order,
+
+1. source IP / subnet          (ROUTES_BY_SOURCE)
+2. rack/slot of the COTP CR     (ROUTES_BY_TSAP, read from the first packet)
+3. listener port               (ROUTES_BY_PORT)
+
+Each PLC has its own session lock and a small bounded wait queue, plus an
+optional `allow` list of student IPs/subnets. Route lookups are dict hits
+(one per distinct subnet prefix length), so routing adds no per-connection
+scanning. Put a plc_routes.json next to this script to override the tables:
+
+    {"plcs": {"plc1": {"ip": "192.168.0.10"}, "plc2": {"ip": "192.168.0.11", "allow": ["192.168.1.0/24"]}},
+     "by_source": {"192.168.1.0/28": "plc2"},
+     "by_tsap": {"0/2": "plc2"},
+     "by_port": {"102": "plc1", "1102": "plc2"}}
+"""
+import ipaddress
+import json
+import os
 import socket
 import threading
+import time
 
-PLC_IP = "192.168.0.10"   # <-- change to your PLC IP
+# ---------------- CONFIGURATION ----------------
 PLC_PORT = 102
 
 PI_LISTEN_IP = "0.0.0.0"
-PI_LISTEN_PORT = 102
 
-plc_lock = threading.Lock()
+# name -> {"ip": ..., "port": ..., "allow": [student IPs/subnets] (optional)}
+PLCS = {
+    "plc1": {"ip": "192.168.0.10", "port": PLC_PORT},   # <-- change to your PLC IP
+}
+ROUTES_BY_SOURCE = {}           # "192.168.1.0/28" -> PLC name
+ROUTES_BY_TSAP = {}             # "rack/slot" -> PLC name
+ROUTES_BY_PORT = {102: "plc1"}  # listener port -> PLC name (also the ports we listen on)
+
+QUEUE_SIZE = 2                  # Students allowed to wait for a busy PLC
+QUEUE_TIMEOUT = 10              # Seconds a waiting student is held before BUSY
+CR_TIMEOUT = 2                  # Seconds to wait for the COTP connection request
+METRICS_INTERVAL = 300          # Seconds between metrics reports
+
+ROUTES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plc_routes.json")
+# ------------------------------------------------
+
+
+class SubnetTable:
+    """Longest-prefix match with one dict lookup per distinct prefix length"""
+
+    def __init__(self, entries=()):
+        self._by_prefix = {}   # prefixlen -> {network address int: value}
+        self._prefixes = []
+        for network, value in entries:
+            self.add(network, value)
+
+    def add(self, network, value):
+        net = ipaddress.ip_network(network, strict=False)
+        self._by_prefix.setdefault(net.prefixlen, {})[int(net.network_address)] = value
+        self._prefixes = sorted(self._by_prefix, reverse=True)
+
+    def lookup(self, ip, default=None):
+        address = int(ipaddress.IPv4Address(ip))
+        for prefix in self._prefixes:
+            mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+            value = self._by_prefix[prefix].get(address & mask)
+            if value is not None:
+                return value
+        return default
+
+    def __bool__(self):
+        return bool(self._by_prefix)
+
+
+class PlcTarget:
+    def __init__(self, name, ip, port=PLC_PORT, allow=None):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.allow = SubnetTable((net, True) for net in allow) if allow else None
+        self.lock = threading.Lock()
+        self.queue = threading.Semaphore(QUEUE_SIZE + 1)  # Active session + waiting students
+        self.metrics = {"sessions": 0, "busy": 0, "denied": 0, "bytes_up": 0, "bytes_down": 0}
+
+    def allows(self, client_ip):
+        return self.allow is None or self.allow.lookup(client_ip, False)
+
+    def acquire(self):
+        """Take the PLC, waiting in its queue; False if full or timed out"""
+        if not self.queue.acquire(blocking=False):
+            return False
+        if not self.lock.acquire(timeout=QUEUE_TIMEOUT):
+            self.queue.release()
+            return False
+        return True
+
+    def release(self):
+        self.lock.release()
+        self.queue.release()
+
+
+# ---------------- ROUTING TABLES ----------------
+targets = {}
+by_source = SubnetTable()
+by_tsap = {}
+by_port = {}
+
+
+def load_routes():
+    """Build the routing tables from the config (or plc_routes.json)"""
+    global targets, by_source, by_tsap, by_port
+
+    plcs, sources, tsaps, ports = PLCS, ROUTES_BY_SOURCE, ROUTES_BY_TSAP, ROUTES_BY_PORT
+    if os.path.exists(ROUTES_FILE):
+        with open(ROUTES_FILE, "r") as f:
+            config = json.load(f)
+        plcs = config.get("plcs", plcs)
+        sources = config.get("by_source", sources)
+        tsaps = config.get("by_tsap", tsaps)
+        ports = config.get("by_port", ports)
+        print(f"[INFO] Loaded routes for {len(plcs)} PLC(s) from {ROUTES_FILE}")
+
+    targets = {name: PlcTarget(name, cfg["ip"], int(cfg.get("port", PLC_PORT)), cfg.get("allow"))
+               for name, cfg in plcs.items()}
+    routes = list(sources.values()) + list(tsaps.values()) + list(ports.values())
+    unknown = set(routes) - set(targets)
+    if unknown:
+        raise ValueError(f"Routes point to unknown PLC(s): {', '.join(sorted(unknown))}")
+
+    by_source = SubnetTable((net, targets[name]) for net, name in sources.items())
+    by_tsap = {tuple(int(v) for v in str(key).split("/")): targets[name] for key, name in tsaps.items()}
+    by_port = {int(port): targets[name] for port, name in ports.items()}
+
 
-def handle_client(client_socket, client_addr):
-    print(f"[INFO] Student connected: {client_addr}")
+def parse_cr_rack_slot(data):
+    """Return (rack, slot) from the destination TSAP of a COTP connection request"""
+    # TPKT: version 3, reserved, length(2); COTP: length, PDU type 0xE0 (CR),
+    # dst ref(2), src ref(2), class, then parameters (code, length, value)
+    if len(data) < 11 or data[0] != 0x03 or data[5] != 0xE0:
+        return None
+    end = min(len(data), 5 + data[4])
+    offset = 11
+    while offset + 2 <= end:
+        code, length = data[offset], data[offset + 1]
+        if code == 0xC2 and length == 2 and offset + 4 <= len(data):
+            rack_slot = data[offset + 3]
+            return rack_slot >> 5, rack_slot & 0x1F
+        offset += 2 + length
+    return None
 
-    if not plc_lock.acquire(blocking=False):
+
+def route(client_socket, client_ip, listen_port):
+    """Pick the PLC for a client; returns (target, bytes already read)"""
+    target = by_source.lookup(client_ip) if by_source else None
+    first = b""
+    if target is None and by_tsap:
+        client_socket.settimeout(CR_TIMEOUT)
+        try:
+            first = client_socket.recv(4096)
+        except OSError:
+            pass  # Timeout or reset: fall back to the port route
+        finally:
+            client_socket.settimeout(None)
+        target = by_tsap.get(parse_cr_rack_slot(first))
+    if target is None:
+        target = by_port.get(listen_port)
+    return target, first
+
+
+# ---------------- FORWARDING ----------------
+def handle_client(client_socket, client_addr, listen_port):
+    print(f"[INFO] Student connected: {client_addr} on port {listen_port}")
+
+    target, first = route(client_socket, client_addr[0], listen_port)
+    if target is None:
+        print(f"[WARN] No PLC route for {client_addr}")
+        client_socket.close()
+        return
+
+    if not target.allows(client_addr[0]):
+        target.metrics["denied"] += 1
+        print(f"[WARN] {client_addr[0]} is not allowed on {target.name}")
+        client_socket.close()
+        return
+
+    if not target.acquire():
+        target.metrics["busy"] += 1
         client_socket.send(b"PLC BUSY, try again later.\n")
         client_socket.close()
         return
 
+    plc_socket = None
     try:
+        target.metrics["sessions"] += 1
         plc_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        plc_socket.connect((PLC_IP, PLC_PORT))
+        plc_socket.connect((target.ip, target.port))
+        if first:
+            plc_socket.sendall(first)
+            target.metrics["bytes_up"] += len(first)
 
-        def forward(src, dst):
-            while True:
-                data = src.recv(4096)
-                if not data:
-                    break
-                dst.sendall(data)
+        def forward(src, dst, counter):
+            try:
+                while True:
+                    data = src.recv(4096)
+                    if not data:
+                        break
+                    dst.sendall(data)
+                    target.metrics[counter] += len(data)
+            except OSError:
+                pass
+            finally:
+                # Unblock the other direction
+                try:
+                    dst.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
-        t1 = threading.Thread(target=forward, args=(client_socket, plc_socket))
-        t2 = threading.Thread(target=forward, args=(plc_socket, client_socket))
+        t1 = threading.Thread(target=forward, args=(client_socket, plc_socket, "bytes_up"))
+        t2 = threading.Thread(target=forward, args=(plc_socket, client_socket, "bytes_down"))
         t1.start()
         t2.start()
         t1.join()
         t2.join()
 
+    except OSError as e:
+        print(f"[ERROR] {target.name} ({target.ip}) unreachable: {e}")
     finally:
-        plc_lock.release()
+        target.release()
+        if plc_socket:
+            plc_socket.close()
         client_socket.close()
-        print(f"[INFO] PLC free now.")
+        print(f"[INFO] {target.name} free now.")
 
-def start_gateway():
+
+def listen(port):
+    """Bind and listen on one gateway port; raises OSError if the port is unavailable"""
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((PI_LISTEN_IP, PI_LISTEN_PORT))
-    server.listen(5)
-    print(f"[INFO] PLC Gateway listening on {PI_LISTEN_IP}:{PI_LISTEN_PORT}")
+    try:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((PI_LISTEN_IP, port))
+        server.listen(5)
+    except OSError:
+        server.close()
+        raise
+    print(f"[INFO] PLC Gateway listening on {PI_LISTEN_IP}:{port}")
+    return server
+
 
+def serve(server, port):
     while True:
         client_socket, client_addr = server.accept()
-        threading.Thread(target=handle_client, args=(client_socket, client_addr)).start()
+        threading.Thread(target=handle_client, args=(client_socket, client_addr, port),
+                         daemon=True).start()
+
+
+def report_metrics():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        for target in targets.values():
+            m = target.metrics
+            print(f"[METRICS] {target.name}: sessions={m['sessions']} busy={m['busy']} "
+                  f"denied={m['denied']} up={m['bytes_up']}B down={m['bytes_down']}B")
+
+
+def start_gateway():
+    load_routes()
+
+    # Bind every port up front: a gateway missing one of its routes (port
+    # taken, or not root for 102) must fail instead of running without it
+    servers = {}
+    try:
+        for port in by_port:
+            servers[port] = listen(port)
+    except OSError as e:
+        for server in servers.values():
+            server.close()
+        raise RuntimeError(f"PLC Gateway cannot listen on port {port}: {e}") from e
+
+    threading.Thread(target=report_metrics, daemon=True).start()
+    listeners = [threading.Thread(target=serve, args=(server, port), daemon=True)
+                 for port, server in servers.items()]
+    for listener in listeners:
+        listener.start()
+    for listener in listeners:
+        listener.join()
 
 if __name__ == "__main__":
     start_gateway()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+On-device QR Decoder
+====================
+Decodes QR codes from the camera frames as a second verification
+channel next to the USB scanner.
+
+- push() is a capture-loop listener. It never blocks: when every worker
+  is busy, the frame is parked as "newest pending" and replaces any older
+  pending frame, so only the most recent frame is ever decoded.
+- Frames are ROI-cropped, converted to grayscale and downscaled to
+  QR_MAX_WIDTH before being sent to the worker processes, which keeps
+  the pickling cost small.
+- Workers are separate processes (spawned, so they do not inherit the
+  camera handle) each running its own cv2.QRCodeDetector; throughput
+  scales with the Pi 5's cores instead of fighting the GIL. start()
+  launches all of them up front, before the camera is opened, and they
+  only import qr_worker (cv2), not the entry script.
+- The same payload is reported once until it has been out of view for
+  DEDUP_SECONDS.
+
+Usage:
+    decoder = QrDecoder(on_decode=lambda payload: ...).start()
+    source.listeners.append(decoder.push)
+"""
+
+import contextlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import cv2
+
+import qr_worker
+from kiosk_log import get_logger
+
+# ---------------- CONFIGURATION ----------------
+# Leave one core for capture and the WebRTC encoder
+QR_WORKERS = int(os.environ.get("QR_WORKERS", max(1, (os.cpu_count() or 4) - 1)))
+QR_MAX_WIDTH = 640            # Downscale wider crops to this width
+DEDUP_SECONDS = 3.0           # Forget a payload after this long out of view
+WORKER_START_TIMEOUT = 30     # Seconds start() waits for the worker processes
+# ------------------------------------------------
+
+log = get_logger("qr")
+
+
+@contextlib.contextmanager
+def _without_main_script():
+    """Stop spawned workers from re-running the entry script.
+
+    spawn normally imports the parent's __main__ in every child, which for
+    adaptive_camera.py means aiortc, av and aiohttp in each worker. The
+    workers only need qr_worker, so hide __main__ while they are launched.
+    """
+    main = sys.modules["__main__"]
+    saved = {name: getattr(main, name, None) for name in ("__file__", "__spec__")}
+    main.__spec__ = None
+    main.__dict__.pop("__file__", None)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is not None:
+                setattr(main, name, value)
+
+
+class QrDecoder:
+    def __init__(self, on_decode, workers=QR_WORKERS, crop=None):
+        self.on_decode = on_decode   # fn(payload), called on a pool callback thread
+        self.workers = workers
+        self.crop = crop             # fn(frame) -> ROI view, optional
+
+        self._pool = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._pending = None
+        self._seen = {}              # payload -> last time it was decoded
+        self.decoded = 0
+        self.dropped = 0             # Frames replaced before a worker was free
+
+    def start(self):
+        """Launch every worker process now (blocking) rather than on the first frame"""
+        self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                         mp_context=multiprocessing.get_context("spawn"),
+                                         initializer=qr_worker.init)
+        # Workers are spawned on submit; N concurrent warm-up tasks start all N
+        with _without_main_script():
+            warmup = [self._pool.submit(qr_worker.ping) for _ in range(self.workers)]
+        wait(warmup, timeout=WORKER_START_TIMEOUT)
+        log.info("🔎 QR decoder started with %d worker(s)", self.workers)
+        return self
+
+    def close(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    # ---------------- CAPTURE SIDE ----------------
+    def push(self, timestamp, frame):
+        """Capture-loop listener; submits or parks the newest frame"""
+        with self._lock:
+            if self._in_flight >= self.workers:
+                if self._pending is not None:
+                    self.dropped += 1
+                self._pending = (timestamp, frame)
+                return
+            self._in_flight += 1
+        self._submit(timestamp, frame)
+
+    def _prepare(self, frame):
+        if self.crop:
+            frame = self.crop(frame)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height, width = gray.shape
+        if width > QR_MAX_WIDTH:
+            gray = cv2.resize(gray, (QR_MAX_WIDTH, height * QR_MAX_WIDTH // width),
+                              interpolation=cv2.INTER_AREA)
+        return gray
+
+    def _submit(self, timestamp, frame):
+        try:
+            future = self._pool.submit(qr_worker.decode, self._prepare(frame))
+        except Exception as e:
+            with self._lock:
+                self._in_flight -= 1
+            log.warning("⚠ QR submit failed: %s", e, every=30)
+            return
+        future.add_done_callback(lambda f: self._done(timestamp, f))
+
+    # ---------------- RESULTS ----------------
+    def _done(self, timestamp, future):
+        try:
+            payloads = [] if future.cancelled() else future.result()
+        except Exception as e:
+            log.warning("⚠ QR decode failed: %s", e, every=30)
+            payloads = []
+
+        for payload in payloads:
+            last = self._seen.get(payload)
+            self._seen[payload] = timestamp
+            if last is None or timestamp - last > DEDUP_SECONDS:
+                self.decoded += 1
+                log.info("🔎 QR decoded: %s", payload)
+                try:
+                    self.on_decode(payload)
+                except Exception as e:
+                    log.error("❌ QR handler failed: %s", e)
+        if len(self._seen) > 64:
+            horizon = time.time() - DEDUP_SECONDS
+            self._seen = {p: t for p, t in self._seen.items() if t >= horizon}
+
+        # Hand the worker the newest parked frame, if any
+        with self._lock:
+            pending, self._pending = self._pending, None
+            if pending is None:
+                self._in_flight -= 1
+        if pending is not None:
+            self._submit(*pending)
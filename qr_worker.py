@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+QR Decoder Worker
+=================
+Code that runs inside the QR decoder worker processes. It only needs
+cv2, so a spawned worker imports this module and nothing else (see
+QrDecoder.start, which keeps the workers from re-importing the camera
+server with aiortc/av/aiohttp).
+"""
+
+import os
+
+import cv2
+
+_detector = None
+
+
+def init():
+    global _detector
+    _detector = cv2.QRCodeDetector()
+
+
+def ping():
+    """Warm-up task: returns once the worker process is up"""
+    return os.getpid()
+
+
+def decode(gray):
+    """Return every payload found in the grayscale image `gray`"""
+    ok, payloads, _, _ = _detector.detectAndDecodeMulti(gray)
+    if not ok:
+        return []
+    return [payload for payload in payloads if payload]
@@ -1,13 +1,19 @@
 #!/bin/bash
 # -----------------------------------------
-# Script to launch VL53L0X sensor app and Chromium kiosk inside venv
+# Script to launch the kiosk supervisor (VL53L0X sensor app and Chromium
+# kiosk, plus any other components listed in KIOSK_SERVICES) inside venv
 # -----------------------------------------
 
 # Path to your project folder
 PROJECT_DIR="/home/admin/Remote_Access_IA"
 
+# Server IP and device name come from kiosk.json (or KIOSK_SERVER_IP /
+# KIOSK_DEVICE_NAME); no GUI prompt is needed. Components to run in the
+# single supervisor process:
+KIOSK_SERVICES="${KIOSK_SERVICES:-sensor}"
+
 # Activate virtual environment inside project folder
 source "$PROJECT_DIR/venv/bin/activate"
 
 # Run the Python app
-python3 "$PROJECT_DIR/LED-flash2.py"
+python3 "$PROJECT_DIR/kiosk_supervisor.py" $KIOSK_SERVICES
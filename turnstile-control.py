@@ -4,11 +4,19 @@ Raspberry Pi 5 Turnstile Controller
 ====================================
 Connects to SvelteKit SSE endpoint and controls solenoid via GPIO
 
-Hardware Setup:
+Hardware Setup (per lane, see LANES below):
 - GPIO 17: Solenoid relay (unlock turnstile)
 - GPIO 27: LED indicator (optional status LED)
 - Yuriot ScanCode Box: USB QR/Barcode scanner (auto-detected)
 
+A single process can drive a whole bank of gates: every lane gets its own
+solenoid/LED pins and unlock duration, and all lanes share one SSE stream
+and one GPIO chip handle. Put a lanes.json next to this script to override
+the built-in table, e.g.:
+
+    {"gate1": {"solenoid_pin": 17, "led_pin": 27, "unlock_duration": 3},
+     "gate2": {"solenoid_pin": 22, "led_pin": 23}}
+
 Requirements:
 - pip3 install requests lgpio
 - Run with sudo: sudo python3 turnstile-controller.py
@@ -17,39 +25,127 @@ Requirements:
 """
 
 import time
+_T0 = time.perf_counter()  # Startup budget is measured from here
+
+# requests/urllib3 are imported by the SSE thread when it starts, so GPIO
+# and Chromium do not wait for them.
 import json
-import requests
 import lgpio
 import subprocess
 import threading
-import urllib3
 import glob
 import os
-
-# Disable SSL warnings for self-signed certificates
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from event_journal import JOURNAL_DIR, NullJournal, open_journal
+from kiosk_config import load_config, startup_report
+from kiosk_http import new_session, notify_camera
+from kiosk_log import get_logger, span
 
 # ---------------- CONFIGURATION ----------------
 SOLENOID_PIN = 17       # GPIO pin for solenoid relay
 LED_PIN = 27            # GPIO pin for status LED (optional)
 PORT = "5173"           # SvelteKit dev port (use 4173 for preview)
 UNLOCK_DURATION = 3     # Seconds to keep solenoid energized
-# 🔧 CHANGE THIS IP TO YOUR DEVICE'S IP ADDRESS
+# 🔧 CHANGE THIS IP TO YOUR DEVICE'S IP ADDRESS (or set it in kiosk.json,
+# KIOSK_SERVER_IP or --server-ip)
 # Find your IP: ifconfig (Linux) or ipconfig (Windows)
 SERVER_IP = "172.27.44.225"  # ← CHANGE THIS LINE
 
 WEB_URL = f"https://{SERVER_IP}:{PORT}/"
 SSE_URL = f"https://{SERVER_IP}:{PORT}/api/turnstile"
+EVENTS_URL = f"https://{SERVER_IP}:{PORT}/api/events"  # Journal upload
 DEVICE_NAME = "device1"  # Default device name
+SSE_READY_TIMEOUT = 5   # Seconds startup waits for the first SSE connection
+CAMERA_EVENT_URL = ""   # Camera server /event (records unlock/failed clips), "" = off
+
+# Lane table: device name -> pins and unlock duration.
+# Missing keys in lanes.json fall back to the defaults above.
+LANES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lanes.json")
+LANES = {
+    DEVICE_NAME: {"solenoid_pin": SOLENOID_PIN, "led_pin": LED_PIN, "unlock_duration": UNLOCK_DURATION},
+}
 # ------------------------------------------------
 
 # ---------------- GLOBAL VARIABLES --------------
+log = get_logger("turnstile")
 chip = None
+owns_chip = False              # False when the kiosk supervisor owns the chip handle
+http = None                    # requests.Session, created lazily (or injected by the supervisor)
+gpio_lock = threading.Lock()   # Serializes writes so bank-wide events are atomic
 sse_thread = None
+sse_connected = threading.Event()  # Set once the SSE stream is open
+journal = NullJournal()         # Replaced by the real journal once it has started
 running = False
 # ------------------------------------------------
 
 
+def apply_config(config):
+    """Rebuild server URLs and the default lane from a kiosk config dict"""
+    global SERVER_IP, PORT, WEB_URL, SSE_URL, EVENTS_URL, DEVICE_NAME, LANES, CAMERA_EVENT_URL
+
+    SERVER_IP = config["server_ip"]
+    PORT = config["port"]
+    WEB_URL = f"https://{SERVER_IP}:{PORT}/"
+    SSE_URL = f"https://{SERVER_IP}:{PORT}/api/turnstile"
+    EVENTS_URL = f"https://{SERVER_IP}:{PORT}/api/events"
+    CAMERA_EVENT_URL = config.get("camera_event_url", CAMERA_EVENT_URL)
+    if config["device_name"] != DEVICE_NAME:
+        LANES = {config["device_name"]: LANES.pop(DEVICE_NAME)}
+        DEVICE_NAME = config["device_name"]
+
+
+def load_lanes():
+    """Load the lane table from lanes.json (if present) and fill in defaults"""
+    global LANES
+
+    table = LANES
+    if os.path.exists(LANES_FILE):
+        with open(LANES_FILE, 'r') as f:
+            table = json.load(f)
+        print(f"📄 Loaded {len(table)} lane(s) from {LANES_FILE}")
+
+    lanes = {}
+    used_pins = set()
+    for name, cfg in table.items():
+        lane = {
+            "name": name,
+            "solenoid_pin": int(cfg.get("solenoid_pin", SOLENOID_PIN)),
+            "led_pin": int(cfg.get("led_pin", LED_PIN)),
+            "unlock_duration": float(cfg.get("unlock_duration", UNLOCK_DURATION)),
+            "locked_at": 0.0,   # Monotonic time at which the lane should relock
+        }
+        for pin in (lane["solenoid_pin"], lane["led_pin"]):
+            if pin in used_pins:
+                raise ValueError(f"GPIO {pin} is assigned to more than one lane")
+            used_pins.add(pin)
+        lanes[name] = lane
+
+    LANES = lanes
+    return LANES
+
+
+def lane_pins():
+    """Return every GPIO pin used by the lane table"""
+    return [pin for lane in LANES.values() for pin in (lane["solenoid_pin"], lane["led_pin"])]
+
+
+def lanes_for_device(device):
+    """Return the lanes an event addressed to `device` applies to"""
+    if device == 'all':
+        return list(LANES.values())
+    lane = LANES.get(device)
+    return [lane] if lane else []
+
+
+def write_lanes(lanes, solenoid=None, led=None):
+    """Write solenoid and/or LED level for several lanes in one locked step"""
+    with span("gpio", solenoid=solenoid, led=led), gpio_lock:
+        for lane in lanes:
+            if solenoid is not None:
+                lgpio.gpio_write(chip, lane["solenoid_pin"], solenoid)
+            if led is not None:
+                lgpio.gpio_write(chip, lane["led_pin"], led)
+
+
 def wait_for_scanner():
     """Wait for Yuriot ScanCode Box scanner to be connected"""
     print("🔍 Looking for Yuriot ScanCode Box scanner...")
@@ -145,56 +241,80 @@ def wait_for_scanner():
     return False
 
 
-def gpio_setup():
-    """Initialize GPIO pins"""
-    global chip
+def gpio_setup(handle=None):
+    """Initialize GPIO pins for every lane on a single chip handle.
+
+    With `handle`, the lane pins were already claimed on that chip by the
+    kiosk supervisor, which also owns (and closes) the chip.
+    """
+    global chip, owns_chip
 
-    chip = lgpio.gpiochip_open(0)
-    lgpio.gpio_claim_output(chip, SOLENOID_PIN)
-    lgpio.gpio_claim_output(chip, LED_PIN)
-    lgpio.gpio_write(chip, SOLENOID_PIN, 0)  # Start locked
-    lgpio.gpio_write(chip, LED_PIN, 0)       # LED off
-    print("✅ GPIO initialized")
+    if handle is None:
+        chip = lgpio.gpiochip_open(0)
+        owns_chip = True
+        for pin in lane_pins():
+            lgpio.gpio_claim_output(chip, pin)
+    else:
+        chip = handle
+        owns_chip = False
+    write_lanes(LANES.values(), solenoid=0, led=0)  # Start locked, LEDs off
+    print(f"✅ GPIO initialized for {len(LANES)} lane(s)")
 
 
 def gpio_cleanup():
     """Clean up GPIO on exit"""
     global chip
     if chip:
-        lgpio.gpio_write(chip, SOLENOID_PIN, 0)
-        lgpio.gpio_write(chip, LED_PIN, 0)
-        lgpio.gpiochip_close(chip)
+        write_lanes(LANES.values(), solenoid=0, led=0)
+        if owns_chip:
+            lgpio.gpiochip_close(chip)
+        chip = None
         print("✅ GPIO cleaned up")
 
 
-def unlock_turnstile(student_name=None):
-    """Energize solenoid to unlock turnstile"""
-    print(f"🔓 UNLOCKING TURNSTILE" + (f" for {student_name}" if student_name else ""))
-    lgpio.gpio_write(chip, SOLENOID_PIN, 1)
-    lgpio.gpio_write(chip, LED_PIN, 1)  # LED on
-    time.sleep(UNLOCK_DURATION)
-    lgpio.gpio_write(chip, SOLENOID_PIN, 0)
-    lgpio.gpio_write(chip, LED_PIN, 0)
-    print("🔒 Turnstile locked")
+def unlock_turnstile(lanes, student_name=None):
+    """Energize solenoids of the given lanes and schedule their relock"""
+    names = ", ".join(lane["name"] for lane in lanes)
+    log.info("🔓 UNLOCKING TURNSTILE [%s]%s", names, f" for {student_name}" if student_name else "")
+    now = time.monotonic()
+    for lane in lanes:
+        lane["locked_at"] = now + lane["unlock_duration"]
+    write_lanes(lanes, solenoid=1, led=1)
+    for lane in lanes:
+        threading.Timer(lane["unlock_duration"], relock_lane, args=(lane,)).start()
+
+
+def relock_lane(lane):
+    """Relock a lane unless it was unlocked again in the meantime"""
+    if time.monotonic() + 0.01 < lane["locked_at"]:
+        return
+    write_lanes([lane], solenoid=0, led=0)
+    log.info("🔒 Turnstile locked [%s]", lane['name'])
 
 
-def lock_turnstile():
-    """De-energize solenoid to lock turnstile"""
-    lgpio.gpio_write(chip, SOLENOID_PIN, 0)
-    lgpio.gpio_write(chip, LED_PIN, 0)
-    print("🔒 Turnstile locked")
+def lock_turnstile(lanes):
+    """De-energize solenoids of the given lanes"""
+    for lane in lanes:
+        lane["locked_at"] = 0.0
+    write_lanes(lanes, solenoid=0, led=0)
+    log.info("🔒 Turnstile locked [%s]", ", ".join(lane['name'] for lane in lanes))
 
 
 def sse_listener():
     """Listen to SSE events from SvelteKit server"""
-    global running
+    global running, http
+    import requests
+
+    if http is None:
+        http = new_session()   # Also disables SSL warnings for self-signed certificates
 
-    print(f"📡 Connecting to SSE: {SSE_URL}")
+    log.info("📡 Connecting to SSE: %s", SSE_URL)
 
     while running:
         try:
             # Use requests with stream=True for SSE
-            response = requests.get(SSE_URL, stream=True, verify=False, timeout=60)
+            response = http.get(SSE_URL, stream=True, verify=False, timeout=60)
+            sse_connected.set()
 
             for line in response.iter_lines():
                 if not running:
@@ -212,84 +332,82 @@ def sse_listener():
                         data_str = line_str[5:].strip()
                         try:
                             data = json.loads(data_str)
-                            handle_sse_event(data)
+                            with span("sse_event", event=data.get('event')):
+                                handle_sse_event(data)
                         except json.JSONDecodeError:
-                            print(f"⚠️ Invalid JSON: {data_str}")
+                            log.warning("⚠️ Invalid JSON: %s", data_str)
 
         except requests.exceptions.Timeout:
-            print("⏱️ SSE connection timeout, reconnecting...")
+            log.info("⏱️ SSE connection timeout, reconnecting...")
         except requests.exceptions.ConnectionError as e:
-            print(f"❌ Connection error: {e}")
-            print("🔄 Reconnecting in 5 seconds...")
+            log.warning("❌ Connection error: %s, reconnecting in 5 seconds...", e, every=60)
             time.sleep(5)
         except Exception as e:
-            print(f"❌ SSE error: {e}")
+            log.error("❌ SSE error: %s", e)
             time.sleep(5)
 
 
 def handle_sse_event(data):
-    """Handle incoming SSE events"""
+    """Handle incoming SSE events and route them to lanes"""
     event = data.get('event')
     device = data.get('device', 'all')
-    my_device = DEVICE_NAME
 
-    # Only react if message is for this device or for "all"
-    if device != my_device and device != 'all':
-        print(f"📡 Ignoring event for {device} (I am {my_device})")
+    lanes = lanes_for_device(device)
+    if not lanes:
+        log.debug("📡 Ignoring event for %s (lanes: %s)", device, ", ".join(LANES))
         return
 
-    print(f"📨 Event received: {event} | Device: {device}")
+    log.info("📨 Event received: %s | Device: %s", event, device)
 
     if event == 'connected':
-        print("✅ SSE Connected to server!")
-        lgpio.gpio_write(chip, LED_PIN, 1)
+        log.info("✅ SSE Connected to server!")
+        write_lanes(lanes, led=1)
         time.sleep(0.2)
-        lgpio.gpio_write(chip, LED_PIN, 0)
+        write_lanes(lanes, led=0)
 
     elif event == 'unlock' or event == 'verified':
         student_name = data.get('studentName')
         student_id = data.get('studentId')
-        print(f"✅ VERIFIED: {student_name} ({student_id})")
-        # Run unlock in separate thread to not block SSE listener
-        threading.Thread(target=unlock_turnstile, args=(student_name,)).start()
+        log.info("✅ VERIFIED: %s (%s)", student_name, student_id)
+        journal.append("access", {"device": device, "event": event,
+                                  "studentName": student_name, "studentId": student_id})
+        notify_camera(CAMERA_EVENT_URL, lambda: http, "unlock", device, {"studentId": student_id})
+        # Relock is timer-driven, so the SSE listener is never blocked
+        unlock_turnstile(lanes, student_name)
 
     elif event == 'lock':
-        lock_turnstile()
+        journal.append("lock", {"device": device})
+        lock_turnstile(lanes)
 
     elif event == 'failed':
-        print("❌ Verification failed")
+        log.info("❌ Verification failed")
+        journal.append("failed", {"device": device, "studentId": data.get('studentId')})
+        notify_camera(CAMERA_EVENT_URL, lambda: http, "failed", device, {"studentId": data.get('studentId')})
         # Blink LED to indicate failure
         for _ in range(3):
-            lgpio.gpio_write(chip, LED_PIN, 1)
+            write_lanes(lanes, led=1)
             time.sleep(0.1)
-            lgpio.gpio_write(chip, LED_PIN, 0)
+            write_lanes(lanes, led=0)
             time.sleep(0.1)
 
 
-def start_program():
-    """Start the turnstile controller"""
-    global running, sse_thread
-
-    print(f"📍 WEB_URL: {WEB_URL}")
-    print(f"📡 SSE_URL: {SSE_URL}")
-    print(f"🏷️ DEVICE_NAME: {DEVICE_NAME}")
-
-    # Set HID permissions first
-    print("🔧 Setting HID device permissions...")
+def set_hid_permissions():
+    """Make HID devices readable by the browser (WebHID)"""
+    devices = glob.glob('/dev/hidraw*')
+    if not devices:
+        print("⚠️ No HID devices yet, skipping permissions")
+        return
     try:
-        subprocess.run('sudo chmod 666 /dev/hidraw*', shell=True, check=False)
-        print("✅ HID device permissions set")
-    except Exception as e:
-        print(f"⚠️ Failed to set HID permissions: {e}")
+        for device in devices:
+            os.chmod(device, 0o666)
+    except PermissionError:
+        # Not running as root: fall back to sudo, but without a shell
+        subprocess.run(['sudo', 'chmod', '666', *devices], check=False)
+    print(f"✅ HID device permissions set ({len(devices)} device(s))")
 
-    # Initialize GPIO
-    gpio_setup()
-
-    # Now wait for Yuriot ScanCode Box scanner to connect
-    if not wait_for_scanner():
-        print("⚠️ Continuing without scanner detection...")
 
-    # Open Chromium in kiosk mode with auto-permissions
+def launch_chromium():
+    """Open Chromium in kiosk mode with auto-permissions"""
     print("🌐 Launching Chromium kiosk with auto-permissions...")
     subprocess.Popen([
         "/usr/bin/chromium",
@@ -315,15 +433,135 @@ def start_program():
         WEB_URL
     ])
 
-    # Start SSE listener
+
+def start_journal():
+    """Open the local event journal and start its uploader (optional: never fails)"""
+    global journal
+    journal = open_journal(os.path.join(JOURNAL_DIR, "turnstile"), EVENTS_URL, ",".join(LANES))
+
+
+def start_sse():
+    """Start the SSE listener thread and wait briefly for the first connection"""
+    global running, sse_thread
+
     running = True
-    sse_thread = threading.Thread(target=sse_listener, daemon=True)
-    sse_thread.start()
+    # After a supervisor restart the previous listener may still be alive
+    if sse_thread is None or not sse_thread.is_alive():
+        sse_thread = threading.Thread(target=sse_listener, daemon=True)
+        sse_thread.start()
+    if not sse_connected.wait(SSE_READY_TIMEOUT):
+        print(f"⚠️ SSE not connected after {SSE_READY_TIMEOUT}s, still retrying in background")
+
+
+def detect_scanner():
+    """Background scanner discovery; the gate works without it"""
+    if not wait_for_scanner():
+        print("⚠️ Continuing without scanner detection...")
+
+
+def run_startup(phases):
+    """Run startup phases in parallel, respecting their dependencies.
+
+    `phases` is a list of (name, func, deps, background) tuples. Each phase
+    starts as soon as all phases in `deps` have finished; a phase whose
+    dependency failed is skipped. Returns once every foreground phase is done
+    and prints a timing report; background phases report when they finish.
+    """
+    t0 = time.monotonic()
+    done = {name: threading.Event() for name, _, _, _ in phases}
+    results = {}
+
+    def report_line(name):
+        status, start, end = results[name]
+        return f"   {name:<10} {status:<8} +{start:6.2f}s → +{end:6.2f}s ({end - start:.2f}s)"
+
+    def run_phase(name, func, deps, background):
+        for dep in deps:
+            done[dep].wait()
+        start = time.monotonic() - t0
+        if any(results[dep][0] != "ok" for dep in deps):
+            results[name] = ("skipped", start, start)
+        else:
+            try:
+                func()
+                results[name] = ("ok", start, time.monotonic() - t0)
+            except Exception as e:
+                print(f"❌ Startup phase '{name}' failed: {e}")
+                results[name] = ("failed", start, time.monotonic() - t0)
+        done[name].set()
+        if background:
+            print("⏱️ Background startup phase finished:")
+            print(report_line(name))
+
+    foreground = []
+    for name, func, deps, background in phases:
+        thread = threading.Thread(target=run_phase, args=(name, func, deps, background),
+                                  name=f"startup-{name}", daemon=True)
+        thread.start()
+        if not background:
+            foreground.append(name)
+
+    for name in foreground:
+        done[name].wait()
+
+    print(f"⏱️ Startup finished in {time.monotonic() - t0:.2f}s:")
+    for name in foreground:
+        print(report_line(name))
+    pending = [name for name, _, _, _ in phases if not done[name].is_set()]
+    if pending:
+        print(f"   still running in background: {', '.join(pending)}")
+    return results
+
+
+def stop():
+    """Ask the controller to shut down"""
+    global running
+    running = False
+
+
+def start_program(handle=None, chromium=True):
+    """Start the turnstile controller (with `handle`, under the kiosk supervisor).
+
+    The supervisor passes chromium=False and launches the browser itself,
+    once, so restarts of the controller do not open another kiosk window.
+    """
+    global running, journal
+
+    print(f"📍 WEB_URL: {WEB_URL}")
+    print(f"📡 SSE_URL: {SSE_URL}")
+
+    if handle is None:
+        load_lanes()  # The supervisor loads lanes itself to claim their pins
+    for lane in LANES.values():
+        print(f"🏷️ LANE {lane['name']}: solenoid GPIO {lane['solenoid_pin']}, "
+              f"LED GPIO {lane['led_pin']}, unlock {lane['unlock_duration']}s")
+
+    # GPIO and SSE gate entries (the journal is optional and never holds
+    # them up), Chromium starts immediately, and scanner
+    # discovery (up to 30 s) runs in the background instead of blocking.
+    phases = [
+        ("gpio", lambda: gpio_setup(handle), (), False),
+        ("journal", start_journal, (), False),
+        ("sse", start_sse, ("gpio",), False),
+        ("hid", set_hid_permissions, (), False),
+        ("scanner", detect_scanner, ("hid",), True),
+    ]
+    if chromium:
+        phases.append(("chromium", launch_chromium, (), False))
+    results = run_startup(phases)
+    if results["gpio"][0] != "ok":
+        print("❌ GPIO initialization failed, exiting")
+        running = False
+        journal.close()
+        journal = NullJournal()
+        gpio_cleanup()
+        return
 
     print("🚀 Turnstile controller started!")
+    if handle is None:
+        startup_report("Turnstile controller", _T0)
     print("📡 Listening for SSE events...")
     print("💡 Make sure to run with sudo for HID device access: sudo python3 turnstile-controller.py")
-    print("🔍 Yuriot ScanCode Box scanner should be connected and detected")
     print("Press Ctrl+C to exit")
 
     # Keep main thread alive
@@ -334,6 +572,8 @@ def start_program():
         print("\n👋 Shutting down...")
         running = False
     finally:
+        journal.close()
+        journal = NullJournal()
         gpio_cleanup()
 
 
@@ -392,4 +632,10 @@ if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "test":
         test_scanner_detection()
     else:
+        apply_config(load_config({
+            "server_ip": SERVER_IP,
+            "port": PORT,
+            "device_name": DEVICE_NAME,
+            "camera_event_url": CAMERA_EVENT_URL,
+        }, description="Turnstile controller"))
         start_program()
\ No newline at end of file